@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+import os
+import sys
+import copy
+import time
+import argparse
+import subprocess
+import tracemalloc
+
+'''benchmarks for the tools in this repository. run through the cli, e.g.
+python cli.py bench import-time. chainer and the tools are only imported by
+the benchmarks that run them'''
+
+# modules behind the entry points, cheapest first
+ENTRY_POINTS = ['cli', 'score', 'scaling', 'run_dknn', 'registry',
+                'interpretations', 'train_text_classifier']
+
+
+def import_time(module, repeat=5):
+    '''best wall time of importing module in a fresh interpreter'''
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', 'import ' + module],
+                              cwd=cwd)
+        best = min(best, time.time() - start)
+    return best
+
+
+def bench_import_time(args):
+    baseline = import_time('sys', args.repeat)
+    print('{:<24}{:>10}{:>10}'.format('module', 'total', 'import'))
+    print('{:<24}{:>10.3f}{:>10}'.format('(interpreter)', baseline, '-'))
+    for module in args.modules or ENTRY_POINTS:
+        t = import_time(module, args.repeat)
+        print('{:<24}{:>10.3f}{:>10.3f}'.format(module, t, t - baseline))
+
+
+def peak_memory(func, device):
+    '''runs func, returns its result and the peak memory it allocated: host
+    memory traced by tracemalloc on the CPU, the growth of the cupy memory
+    pool (which keeps freed blocks) on a GPU'''
+    if device < 0:
+        tracemalloc.start()
+        try:
+            result = func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return result, peak
+    from chainer.backends import cuda
+    pool = cuda.cupy.get_default_memory_pool()
+    pool.free_all_blocks()
+    before = pool.total_bytes()
+    result = func()
+    cuda.Stream.null.synchronize()
+    return result, pool.total_bytes() - before
+
+
+def forward_pass(model, data, converter, device, batch_size, graph=False):
+    '''the model part of DkNN.build and evaluation: probabilities and all
+    dknn layers of data, copied to the host. with graph, the model runs
+    with train=False only, so the graph for backprop is kept like before
+    nets.inference_mode'''
+    import chainer
+    from iterators import BucketIterator
+    from nets import export_layers
+    data_iter = BucketIterator(data, batch_size, repeat=False, shuffle=False)
+    for batch in data_iter:
+        xs = converter(batch, device=device)['xs']
+        if graph:
+            with chainer.using_config('train', False):
+                _, layers = model.predict(xs, softmax=True, dknn=True)
+            export_layers(layers)
+        else:
+            model.export_activations(xs)
+    return len(data)
+
+
+def dknn_pass(dknn, train, test, converter, device, batch_size):
+    '''builds the index of dknn on train, then predicts test'''
+    from iterators import BucketIterator
+    dknn.build(train, batch_size=batch_size, converter=converter,
+               device=device)
+    test_iter = BucketIterator(test, batch_size, repeat=False, shuffle=False)
+    for batch in test_iter:
+        dknn.predict(converter(batch, device=device)['xs'],
+                     snli=converter.snli)
+    return len(train) + len(test)
+
+
+def bench_dknn(args):
+    import numpy as np
+    from nets import cast_params
+    from nlp_utils import PackedSeqConverter
+    from run_dknn import DkNN
+    from utils import setup_model
+
+    model, train, test, _, setup = setup_model(args)
+    train, test = train[:args.n_examples], test[:args.n_examples]
+    converter = PackedSeqConverter(snli=setup['dataset'] == 'snli')
+    batch_size = args.batch_size or setup['batchsize']
+
+    models = {'float32': model}
+    for dtype in args.dtypes:
+        if dtype not in models:
+            models[dtype] = cast_params(copy.deepcopy(model), np.dtype(dtype))
+
+    def run(name, func):
+        # one run first, so that lazy initialization and memory pools of
+        # the timed run are already warm. memory is measured by another
+        # run, tracing allocations slows it down
+        func()
+        start = time.time()
+        n = func()
+        elapsed = time.time() - start
+        _, peak = peak_memory(func, args.gpu)
+        print('{:<28}{:>14.1f}{:>14.1f}'.format(
+            name, n / elapsed, peak / 2. ** 20))
+
+    print('{:<28}{:>14}{:>14}'.format('run', 'examples/s', 'peak MiB'))
+    for data_name, data in (('build', train), ('evaluate', test)):
+        run('forward {} graph'.format(data_name),
+            lambda: forward_pass(model, data, converter, args.gpu,
+                                 batch_size, graph=True))
+        for dtype in args.dtypes:
+            run('forward {} {}'.format(data_name, dtype),
+                lambda: forward_pass(models[dtype], data, converter,
+                                     args.gpu, batch_size))
+    for dtype in args.dtypes:
+        dknn = DkNN(models[dtype], algorithm='brute')
+        run('dknn build+evaluate {}'.format(dtype),
+            lambda: dknn_pass(dknn, train, test, converter, args.gpu,
+                              batch_size))
+
+
+BENCHMARKS = {'import-time': bench_import_time, 'dknn': bench_dknn}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    p = subparsers.add_parser(
+        'import-time', help='time to import each entry point module')
+    p.add_argument('--repeat', type=int, default=5,
+                   help='Number of runs, the best one is reported.')
+    p.add_argument('modules', nargs='*',
+                   help='Modules to import (default: all entry points).')
+
+    p = subparsers.add_parser(
+        'dknn', help='throughput and peak memory of the forward passes of '
+                     'DkNN build and evaluation, keeping the graph or in '
+                     'inference mode, in float32 and float16')
+    p.add_argument('--model-setup', required=True,
+                   help='Model setup dictionary.')
+    p.add_argument('--gpu', '-g', type=int, default=-1,
+                   help='GPU ID (negative value indicates CPU)')
+    p.add_argument('--n-examples', type=int, default=2000,
+                   help='Number of training and test examples used.')
+    p.add_argument('--batch-size', type=int, default=None,
+                   help='Batch size (default: the one of the model).')
+    p.add_argument('--dtypes', nargs='+', choices=('float32', 'float16'),
+                   default=['float32', 'float16'],
+                   help='Dtypes of the model in inference mode (float16 is \
+                         slow on CPUs, which have no half precision units).')
+
+    args = parser.parse_args(argv)
+    # dispatched by name: args is dumped as json by setup_model
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+import sys
+import argparse
+import importlib
+
+'''single entry point for all of the tools, e.g.
+
+    python cli.py train --dataset stsa.binary --model cnn
+    python cli.py dknn --model-setup result/stsa.binary_cnn/args.json
+
+each command lives in its own module, which is only imported when the
+command runs. heavy libraries (chainer, nearpy, scikit-learn, matplotlib)
+are therefore only loaded by the commands that need them'''
+
+# command: (module with a main(argv) function, description)
+COMMANDS = {
+    'train': ('train_text_classifier', 'train a classification model'),
+    'dknn': ('run_dknn', 'run a model with and without DkNN'),
+    'scale': ('scaling', 'fit a temperature to the calibration set'),
+    'interpret': ('interpretations', 'generate saliency maps'),
+    'score': ('score', 'classify raw sentences'),
+    'serve': ('registry', 'classify sentences with several loaded models'),
+    'bench': ('benchmarks', 'run benchmarks'),
+}
+
+
+def main(argv=None):
+    epilog = 'commands:\n' + '\n'.join(
+        '  {:<12}{}'.format(name, description)
+        for name, (_, description) in sorted(COMMANDS.items()))
+    parser = argparse.ArgumentParser(
+        epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=sorted(COMMANDS),
+                        metavar='command')
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='arguments of the command (see command -h)')
+    args = parser.parse_args(argv)
+
+    module = importlib.import_module(COMMANDS[args.command][0])
+    sys.argv[0] = '{} {}'.format(sys.argv[0], args.command)  # for usage
+    return module.main(args.args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,32 +4,31 @@ import argparse
 import os
 import json
 import numpy as np
-import cupy as cp
 import warnings
 from functools import partial
-import matplotlib
-import matplotlib.pyplot as plt
 import math
 from collections import defaultdict
 from copy import deepcopy
 
-import chainer
-import chainer.functions as f
+from chainer.backends import cuda
 
-from nlp_utils import convert_seq, convert_snli_seq
-from utils import setup_model
-from run_dknn import dknn
+from nets import inference_mode
+from nlp_utils import PackedSeqConverter
+from utils import setup_model, get_device, split_calibration
+from run_dknn import DkNN
 
-'''generate a batch of snli hypothesis, x, each entry with a different word left out'''
+# converts single sequences, e.g. the hypotheses of snli leave one out
+seq_converter = PackedSeqConverter()
+
+'''generate a batch of snli hypothesis, x, each entry with a different word left out.
+the premise is returned once, the model shares its encoding across the batch'''
 def snli_flatten(x):
     prem, hypo = x
     flatten_hypo = []
-    flatten_prem = []
     for i in range(hypo.shape[0]):
         h = np.concatenate((hypo[:i], hypo[i+1:]), axis=0)
         flatten_hypo.append(h)
-        flatten_prem.append(prem)
-    return (flatten_prem, flatten_hypo)
+    return ([prem], flatten_hypo)
 
 '''generate a batch of examples, x, each entry with a different word left out'''
 def flatten(x):
@@ -40,24 +39,70 @@ def flatten(x):
         xs.append(np.concatenate((x[:i], x[i+1:]), axis=0))
     return xs
 
+'''all leave one out variants of the tokens x, as the rows of a
+(len(x), len(x) - 1) array'''
+def leave_one_out_variants(x):
+    n = len(x)
+    keep = np.nonzero(~np.eye(n, dtype=bool))[1]
+    return x[keep].reshape(n, n - 1)
+
+'''neighbor stability of every word of every example (token arrays, or
+(premise, hypothesis) pairs for snli): the fraction of the dknn neighbors
+of each leave one out variant that are neighbors of the example itself.
+the neighbors of each batch of examples are searched once, and the
+variants in batches of at most batch_size. returns one array of overlaps
+per example (empty for examples of a single word)'''
+def leave_one_out_stability(dknn, converter, examples, snli=False,
+                            batch_size=64):
+    device = get_device(dknn.model)
+    hypotheses = [x[1] if snli else x for x in examples]
+    stability = []
+    for start in range(0, len(examples), batch_size):
+        batch = examples[start:start + batch_size]
+        neighbors = dknn.get_batch_neighbors(
+            converter(batch, device=device, with_label=False))
+        # variants of all examples of the batch, with the example they come
+        # from. snli variants keep the premise of their example
+        variants, owners = [], []
+        for i, x in enumerate(batch):
+            h = hypotheses[start + i]
+            if len(h) < 2:
+                continue
+            for v in leave_one_out_variants(h):
+                variants.append((x[0], v) if snli else v)
+                owners.append(i)
+        overlap = np.empty(len(variants))
+        for v_start in range(0, len(variants), batch_size):
+            chunk = variants[v_start:v_start + batch_size]
+            overlap[v_start:v_start + len(chunk)] = dknn.neighbor_stability(
+                None, converter(chunk, device=device, with_label=False),
+                owners[v_start:v_start + batch_size], neighbors=neighbors)
+        sections = np.cumsum([len(h) if len(h) > 1 else 0
+                              for h in hypotheses[start:start + len(batch)]])
+        stability.extend(np.split(overlap, sections[:-1]))
+    return stability
+
 ''' performs leave one out interpretations. has multiple options for snli (paired inputs)
 or single input tasks. also has options for using dknn credibility or confidence'''
 def leave_one_out(dknn, converter,
                   x,
-                  snli=false,
-                  use_credibility=true):
-    gpu = dknn.model.xp == cp
-    device = 0 if gpu else -1
-    inputs = converter([x], device=device, with_label=false)  # setup gpu stuff
+                  snli=False,
+                  use_credibility=True):
+    device = get_device(dknn.model)
+    inputs = converter([x], device=device, with_label=False)  # setup gpu stuff
     ys, og_score, _, reg_pred, reg_conf = dknn.predict(inputs, snli=snli)  # get original prediction
 
     xs = snli_flatten(x) if snli else flatten(x)    # batch of leave out one word
-    batch_size = len(xs[0]) if snli else len(xs)
+    batch_size = len(xs[1]) if snli else len(xs)
     y = ys[0] if use_credibility else reg_pred[0] # get prediction depending on mode
     ys = [np.array([y], dtype=np.int32) for _ in range(batch_size)]
-    inputs = list(zip(xs[0], xs[1], ys)) if snli else list(zip(xs, ys))
-    inputs = converter(inputs, device=device)
-    xs = inputs['xs']
+    if snli:  # one premise for all hypotheses, encoded once by the model
+        inputs = seq_converter(list(zip(xs[1], ys)), device=device)
+        xs = (seq_converter(xs[0], device=device, with_label=False),
+              inputs['xs'])
+    else:
+        inputs = converter(list(zip(xs, ys)), device=device)
+        xs = inputs['xs']
     ys = inputs['ys']
     
     if use_credibility:  # if dknn, then get scores of each input with words left out
@@ -73,22 +118,23 @@ def leave_one_out(dknn, converter,
 ''' does gradient based interpretations'''
 def vanilla_grad(model, converter,
                  x,
-                 snli=false,
-                 use_credibility=false):
-    gpu = model.xp == cp
-    device = 0 if gpu else -1
-    inputs = converter([x], device=device, with_label=false)    
+                 snli=False,
+                 use_credibility=False):
+    device = get_device(model)
+    inputs = converter([x], device=device, with_label=False)    
     if snli:
         warnings.warn('snli not supported for vanilla grad')
-    with chainer.using_config('train', false):
-        output = cp.asnumpy(model.predict(inputs, softmax=true))
+    with inference_mode():
+        output = cuda.to_cpu(model.predict(inputs, softmax=True))
         y = np.argmax(output)
         original_score = np.max(output)
     onehot_grad = model.get_onehot_grad([x])[0].data.tolist()
     return y, original_score, onehot_grad
 
 ''' generates saliency map visualizations as seen in the paper'''
-def colorize(words, color_array, colors='rdbu'):
+def colorize(words, color_array, colors='RdBu'):
+    import matplotlib  # only needed for the visualizations
+    import matplotlib.pyplot as plt
     # words is a list of words
     # color_array is an array of numbers between 0 and 1
     cmap = plt.cm.get_cmap(colors)
@@ -103,46 +149,66 @@ def colorize(words, color_array, colors='rdbu'):
     return colored_string
 
 
-def main():
-    parser = argparse.argumentparser()
+def main(argv=None):
+    parser = argparse.ArgumentParser()
     parser.add_argument('--gpu', '-g', type=int, default=0,
                         help='gpu id (negative value indicates cpu)')
-    parser.add_argument('--model-setup', required=true,
+    parser.add_argument('--model-setup', required=True,
                         help='model setup dictionary.')
-    parser.add_argument('--lsh', action='store_true', default=false,
+    parser.add_argument('--lsh', action='store_true', default=False,
                         help='if true, uses locally sensitive hashing \
                               (with k=10 nn) for nn search.')
     parser.add_argument('--interp_method', type=str, default='dknn',
                         help='choose dknn, softmax, or grad')
+    parser.add_argument('--stability', action='store_true', default=False,
+                        help='print the neighbor stability of each word of \
+                              the test examples (the share of neighbors \
+                              kept when it is left out) instead of the \
+                              saliency maps.')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     model, train, test, vocab, setup = setup_model(args)
     reverse_vocab = {v: k for k, v in vocab.items()}
 
-    use_snli = false
+    use_snli = False
     if setup['dataset'] == 'snli':  # if snli, change colors and set flags
-        converter = convert_snli_seq
-        colors = 'piyg'  
-        use_snli = true
+        converter = PackedSeqConverter(snli=True)
+        colors = 'PiYG'  
+        use_snli = True
     else:
-        converter = convert_seq
-        colors = 'rdbu'
+        converter = PackedSeqConverter()
+        colors = 'RdBu'
 
     with open(os.path.join(setup['save_path'], 'calib.json')) as f:
         calibration_idx = json.load(f)
 
-    calibration = [train[i] for i in calibration_idx]
-    train = [x for i, x in enumerate(train) if i not in calibration_idx]
+    train, calibration = split_calibration(train, calibration_idx)
 
     '''get dknn layers of training data'''
-    dknn = dknn(model, lsh=args.lsh)
+    dknn = DkNN(model, lsh=args.lsh)
     dknn.build(train, batch_size=setup['batchsize'],
                converter=converter, device=args.gpu)
 
     '''calibrate the dknn credibility values'''
     dknn.calibrate(calibration, batch_size=setup['batchsize'],
                    converter=converter, device=args.gpu)
+    dknn.set_text_store(train, vocab, setup['char_based'])
+
+    if args.stability:  # words whose removal changes the neighbors most
+        examples = [(x[0], x[1]) if use_snli else x[0] for x in test]
+        stability = leave_one_out_stability(
+                dknn, converter, examples, snli=use_snli,
+                batch_size=setup['batchsize'])
+        for x, overlaps in zip(examples, stability):
+            hypo = x[1] if use_snli else x
+            if use_snli:
+                print('premise: ' + ' '.join(reverse_vocab[w] for w in x[0]))
+            print(' '.join(reverse_vocab[w] for w in hypo))
+            for idx in np.argsort(overlaps, kind='mergesort'):
+                print(overlaps[idx], reverse_vocab[hypo[idx]])
+            print()
+        return
 
     # opens up a html file for printing results. writes a table header to make it pretty
     with open(setup['dataset'] + '_' + setup['model'] + '_colorize.html', 'a') as f:
@@ -194,15 +260,15 @@ def main():
                 normalized_scores.append(score - original_score)  # for l10 drop in score
             else:
                 normalized_scores.append(score)  # for grad its not a drop
-            if snli:
+            if use_snli:
                 words.append(reverse_vocab[hypo[idx]])
             else:
                 words.append(reverse_vocab[text[idx]])
         # flip sign if positive sentiment. i.e., for positive class, drop in score = red highlight.
         # for negative class, drop is score = blue highlight
-        if not snli and prediction == 1:  
+        if not use_snli and prediction == 1:  
             normalized_scores = [-1 * n for n in normalized_scores]            
-        if snli:
+        if use_snli:
             normalized_scores = [-1 * n for n in normalized_scores] # flip sign so green is drop
         
         # normalize scores across the words, doing positive and negatives seperately        
@@ -224,7 +290,7 @@ def main():
         visual = colorize(words, normalized_scores, colors=colors)  # generate saliency map colors
 
         # setup html table row with snli results        
-        if snli:        
+        if use_snli:
             with open(setup['dataset'] + '_' + setup['model'] + '_colorize.html', 'a') as f:
                 if label == 0:
                     f.write('ground truth label: entailment')
@@ -278,13 +344,12 @@ def main():
                 f.write('</tr>')
      
         # print nearest neighbor training data points for interpretation by analogy
-        # neighbors = dknn.get_neighbors(x)
-        # print('neighbors:')        
-        # for neighbor in neighbors[:5]:
-        #    curr_nearest_neighbor_input_sentence = '     '
-        #    for word in train[neighbor][0]:
-        #        curr_nearest_neighbor_input_sentence += reverse_vocab[word] + ' '
-        #    print(curr_nearest_neighbor_input_sentence)        
+        inputs = converter([x], device=args.gpu, with_label=False)
+        print('neighbors:')
+        for neighbor in dknn.get_neighbor_text(inputs, n=5)[0]:
+            if use_snli:
+                neighbor = ' ||| '.join(neighbor)
+            print('     ' + neighbor)
 
     with open(setup['dataset'] + '_' + setup['model'] + '_colorize.html', 'a') as f: # end html table
         f.write('</table>')
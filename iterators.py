@@ -0,0 +1,306 @@
+import collections
+from concurrent import futures
+
+import numpy
+
+import chainer
+from chainer.backends import cuda
+
+from nlp_utils import RaggedDataset
+
+'''dataset iterators used for training and for running the DkNN over a
+dataset'''
+
+
+def example_length(example):
+    '''returns the length of the longest sequence in an example. labels
+    are (1, )-shaped arrays, so they never decide the length'''
+    if isinstance(example, tuple):
+        return max(len(x) for x in example)
+    return len(example)
+
+
+def identity_converter(batch, device=None):
+    '''converter for updaters and evaluators whose iterator already returns
+    converted batches (see PrefetchIterator)'''
+    return batch
+
+
+def restore_order(outputs, indices):
+    '''puts outputs collected in iteration order back into dataset order.
+    indices are the concatenated batch_indices of the iterator'''
+    outputs = numpy.asarray(outputs)
+    restored = numpy.empty_like(outputs)
+    restored[numpy.asarray(indices)] = outputs
+    return restored
+
+
+class BucketIterator(chainer.dataset.Iterator):
+
+    """Dataset iterator that batches examples of similar length.
+
+    Sorting examples by length keeps the padding of each minibatch small.
+    With ``shuffle=True`` the dataset is shuffled, sorted by length within
+    pools of ``pool_size`` batches and the resulting batches are visited in
+    random order, so batches differ from epoch to epoch. Otherwise the
+    examples are visited in length order.
+
+    The dataset positions of the examples of the last returned batch are
+    stored in ``batch_indices``, which can be used with
+    :func:`restore_order` to return outputs in dataset order.
+
+    Args:
+        dataset: Dataset to iterate.
+        batch_size (int): Maximum number of examples in each batch. Can be
+            ``None`` if ``max_tokens`` is given.
+        repeat (bool): If ``True``, it infinitely loops over the dataset.
+            Otherwise, it stops iteration at the end of the first epoch.
+        shuffle (bool): If ``True``, the batches are built and visited in a
+            different random order at each epoch.
+        max_tokens (int): If given, a batch is cut once its padded size
+            (number of examples times the longest length) would exceed
+            this number of tokens.
+        pool_size (int): Number of batches sorted together when shuffling.
+        length_fn (callable): Function returning the length of an example.
+
+    """
+
+    def __init__(self, dataset, batch_size=None, repeat=True, shuffle=True,
+                 max_tokens=None, pool_size=100, length_fn=example_length):
+        if batch_size is None and max_tokens is None:
+            raise ValueError('either batch_size or max_tokens is required')
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.pool_size = pool_size
+        self._repeat = repeat
+        self._shuffle = shuffle
+
+        if isinstance(dataset, RaggedDataset):
+            self._lengths = numpy.diff(dataset.offsets)
+        else:
+            self._lengths = numpy.array(
+                [length_fn(example) for example in dataset], numpy.int64)
+        self.reset()
+
+    def __next__(self):
+        if not self._repeat and self.epoch > 0:
+            raise StopIteration
+
+        self._previous_epoch_detail = self.epoch_detail
+        indices = self._batches[self._batch_pos]
+        batch = [self.dataset[i] for i in indices]
+        self.batch_indices = indices
+        self.current_position += len(indices)
+        self._batch_pos += 1
+
+        if self._batch_pos >= len(self._batches):
+            self.epoch += 1
+            self.is_new_epoch = True
+            self.current_position = 0
+            self._batch_pos = 0
+            self._batches = self._make_batches()
+        else:
+            self.is_new_epoch = False
+        return batch
+
+    next = __next__
+
+    @property
+    def epoch_detail(self):
+        return self.epoch + self.current_position / len(self.dataset)
+
+    @property
+    def previous_epoch_detail(self):
+        if self._previous_epoch_detail < 0:
+            return None
+        return self._previous_epoch_detail
+
+    @property
+    def n_batches(self):
+        '''number of batches in the current epoch'''
+        return len(self._batches)
+
+    def _make_batches(self):
+        n = len(self._lengths)
+        if self._shuffle:
+            order = numpy.random.permutation(n)
+            if self.batch_size is not None:
+                pool = self.pool_size * self.batch_size
+            else:
+                mean_length = max(1, int(self._lengths.mean()))
+                pool = self.pool_size * max(1, self.max_tokens // mean_length)
+            for start in range(0, n, pool):
+                chunk = order[start:start + pool]
+                order[start:start + pool] = chunk[numpy.argsort(
+                    self._lengths[chunk], kind='mergesort')]
+        else:
+            order = numpy.argsort(self._lengths, kind='mergesort')
+
+        batches = []
+        start = 0
+        longest = 0
+        for i, length in enumerate(self._lengths[order].tolist()):
+            if i > start:
+                longest = max(longest, length)
+                full = (self.batch_size is not None and
+                        i - start >= self.batch_size)
+                over = (self.max_tokens is not None and
+                        (i - start + 1) * longest > self.max_tokens)
+                if full or over:
+                    batches.append(order[start:i])
+                    start = i
+            if i == start:
+                longest = length
+        if start < n:
+            batches.append(order[start:])
+
+        if self._shuffle:
+            batches = [batches[i]
+                       for i in numpy.random.permutation(len(batches))]
+        return batches
+
+    def reset(self):
+        self.current_position = 0
+        self.epoch = 0
+        self.is_new_epoch = False
+        self.batch_indices = None
+        self._previous_epoch_detail = -1.
+        self._batch_pos = 0
+        self._batches = self._make_batches()
+
+    def serialize(self, serializer):
+        self.current_position = serializer('current_position',
+                                           self.current_position)
+        self.epoch = serializer('epoch', self.epoch)
+        self.is_new_epoch = serializer('is_new_epoch', self.is_new_epoch)
+        self._batch_pos = serializer('batch_pos', self._batch_pos)
+        self._previous_epoch_detail = serializer(
+            'previous_epoch_detail', self._previous_epoch_detail)
+        if isinstance(serializer, chainer.serializer.Deserializer):
+            order = serializer('order', None)
+            sizes = serializer('sizes', None)
+            self._batches = numpy.split(order, numpy.cumsum(sizes)[:-1])
+        else:
+            serializer('order', numpy.concatenate(self._batches))
+            serializer('sizes', numpy.array(
+                [len(b) for b in self._batches], numpy.int64))
+
+
+class PrefetchIterator(chainer.dataset.Iterator):
+
+    """Iterator that converts upcoming batches in background threads.
+
+    Wraps another iterator and applies ``converter`` to its next
+    ``n_prefetch`` batches in a pool of worker threads while the current
+    batch is in use, so building and staging device arrays overlaps with
+    the model computation. Batches are returned converted, in the order of
+    the wrapped iterator, and the iterator state (``epoch``,
+    ``is_new_epoch``, ``epoch_detail``, ``batch_indices``, ...) always
+    describes the returned batch rather than the prefetched ones.
+
+    Use :func:`identity_converter` as the converter of updaters and
+    evaluators that read from this iterator. Call :meth:`finalize` (the
+    trainer does it for its iterators) to stop the worker threads.
+
+    Args:
+        iterator: Iterator to wrap.
+        converter (callable): Converter applied as
+            ``converter(batch, device=device)``.
+        device (int): Device passed to the converter.
+        n_prefetch (int): Number of batches converted ahead.
+        n_workers (int): Number of worker threads.
+
+    """
+
+    def __init__(self, iterator, converter, device=None, n_prefetch=2,
+                 n_workers=1):
+        self.iterator = iterator
+        self.converter = converter
+        self.device = device
+        self.n_prefetch = max(1, n_prefetch)
+        self._executor = futures.ThreadPoolExecutor(n_workers)
+        self._pending = collections.deque()
+        self._exhausted = False
+        self._state = self._snapshot()
+
+    def _snapshot(self):
+        iterator = self.iterator
+        return {
+            'epoch': iterator.epoch,
+            'is_new_epoch': iterator.is_new_epoch,
+            'epoch_detail': iterator.epoch_detail,
+            'previous_epoch_detail': getattr(
+                iterator, 'previous_epoch_detail', None),
+            'batch_indices': getattr(iterator, 'batch_indices', None),
+        }
+
+    def _convert(self, batch):
+        if self.device is not None and self.device >= 0:
+            with cuda.get_device_from_id(self.device):
+                return self.converter(batch, device=self.device)
+        return self.converter(batch, device=self.device)
+
+    def _fill(self):
+        while not self._exhausted and len(self._pending) < self.n_prefetch:
+            try:
+                batch = self.iterator.next()
+            except StopIteration:
+                self._exhausted = True
+                break
+            future = self._executor.submit(self._convert, batch)
+            self._pending.append((future, self._snapshot()))
+
+    def __next__(self):
+        self._fill()
+        if not self._pending:
+            raise StopIteration
+        future, state = self._pending.popleft()
+        self._fill()
+        batch = future.result()
+        self._state = state
+        return batch
+
+    next = __next__
+
+    @property
+    def epoch(self):
+        return self._state['epoch']
+
+    @property
+    def is_new_epoch(self):
+        return self._state['is_new_epoch']
+
+    @property
+    def epoch_detail(self):
+        return self._state['epoch_detail']
+
+    @property
+    def previous_epoch_detail(self):
+        return self._state['previous_epoch_detail']
+
+    @property
+    def batch_indices(self):
+        return self._state['batch_indices']
+
+    def _drain(self):
+        while self._pending:
+            future, _ = self._pending.popleft()
+            if not future.cancel():
+                future.exception()  # wait, but do not raise
+
+    def reset(self):
+        self._drain()
+        self.iterator.reset()
+        self._exhausted = False
+        self._state = self._snapshot()
+
+    def finalize(self):
+        self._drain()
+        self._executor.shutdown(wait=True)
+        self.iterator.finalize()
+
+    def serialize(self, serializer):
+        # the wrapped iterator is ahead by the prefetched batches, which
+        # are skipped when training resumes
+        self.iterator.serialize(serializer)
@@ -0,0 +1,514 @@
+import os
+import json
+import shutil
+
+import numpy as np
+
+'''nearest neighbor search over the activations of one dknn layer: exact
+search over activations stored in reduced precision (float16 or int8), an
+inverted file index built and searched on disk, and the linear
+projections that reduce the activations before indexing'''
+
+STORAGES = ('float32', 'float16', 'int8')
+METRICS = ('euclidean', 'inner_product')
+
+
+def l2_normalize(X, chunk_size=65536):
+    '''scales the rows of the float array X to unit length, in place and
+    chunk by chunk, so X can be memory mapped'''
+    for start in range(0, len(X), chunk_size):
+        chunk = X[start:start + chunk_size]
+        norms = np.sqrt((chunk.astype(np.float32) ** 2).sum(
+            axis=1, keepdims=True))
+        chunk /= np.maximum(norms, np.finfo(np.float32).tiny)
+    return X
+
+
+def quantize_int8(data):
+    '''scalar quantization of each dimension to 256 levels between its
+    minimum and maximum. returns the int8 codes with the scale and the
+    offset of each dimension, where data ~ (codes + 128) * scale + offset'''
+    data = np.asarray(data, np.float32)
+    offset = data.min(axis=0)
+    scale = (data.max(axis=0) - offset) / 255.
+    scale[scale == 0] = 1.  # constant dimensions, e.g. dead relu units
+    codes = np.rint((data - offset) / scale) - 128
+    return codes.astype(np.int8), scale.astype(np.float32), offset
+
+
+def dequantize_int8(codes, scale, offset):
+    return (codes.astype(np.float32) + 128) * scale + offset
+
+
+class BruteForceIndex(object):
+
+    """Exact nearest neighbor search by matrix products.
+
+    The distances between a batch of queries and the stored vectors are
+    computed chunk by chunk as :math:`|q|^2 - 2 q \\cdot x + |x|^2` with a
+    single matrix product per chunk, keeping the ``k`` best of each query
+    with :func:`numpy.argpartition`. With ``metric='inner_product'`` the
+    neighbors are the vectors of maximum inner product and the search is
+    the matrix product alone. The returned distance is then
+    :math:`1 - q \\cdot x`, the cosine distance when queries and vectors
+    are L2-normalized (:func:`l2_normalize`).
+
+    With ``storage='float16'`` the vectors are kept in half precision and
+    each chunk is widened only while it is searched. With
+    ``storage='int8'`` each dimension is quantized to 256 levels between
+    its minimum and maximum (:func:`quantize_int8`), and the queries are
+    rescaled instead of the stored vectors: :math:`q \\cdot x =
+    (q * scale) \\cdot (codes + 128) + q \\cdot offset`. The index takes
+    one half or one quarter of the float32 memory.
+
+    ``query`` follows :meth:`sklearn.neighbors.KDTree.query`, so the index
+    can be used where a KDTree is.
+
+    Args:
+        data (numpy.ndarray): :math:`(N, D)`-shaped vectors to index.
+        storage (str): ``'float32'``, ``'float16'`` or ``'int8'``.
+        metric (str): ``'euclidean'`` or ``'inner_product'``.
+        chunk_size (int): Number of stored vectors searched at once.
+
+    """
+
+    def __init__(self, data, storage='float32', metric='euclidean',
+                 chunk_size=4096):
+        if storage not in STORAGES:
+            raise ValueError('unknown storage {}, expected one of {}'.format(
+                storage, ', '.join(STORAGES)))
+        if metric not in METRICS:
+            raise ValueError('unknown metric {}, expected one of {}'.format(
+                metric, ', '.join(METRICS)))
+        self.storage = storage
+        self.metric = metric
+        self.chunk_size = chunk_size
+        if storage == 'int8':
+            self.data, self.scale, self.offset = quantize_int8(data)
+        else:
+            self.data = np.ascontiguousarray(data, dtype=storage)
+            self.scale = self.offset = None
+
+        if metric == 'inner_product':
+            self.sq_norms = None
+            return
+        # squared norms of the vectors as they are stored
+        self.sq_norms = np.empty(len(self.data), np.float32)
+        for start in range(0, len(self.data), chunk_size):
+            chunk = self.data[start:start + chunk_size]
+            if storage == 'int8':
+                chunk = dequantize_int8(chunk, self.scale, self.offset)
+            else:
+                chunk = chunk.astype(np.float32)
+            self.sq_norms[start:start + len(chunk)] = (chunk ** 2).sum(axis=1)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def nbytes(self):
+        '''memory taken by the index'''
+        nbytes = self.data.nbytes
+        if self.sq_norms is not None:
+            nbytes += self.sq_norms.nbytes
+        if self.storage == 'int8':
+            nbytes += self.scale.nbytes + self.offset.nbytes
+        return nbytes
+
+    def query(self, X, k=1):
+        '''returns the distances and the indices of the k nearest neighbors
+        of each row of X, both (B, k)-shaped and sorted by distance'''
+        X = np.atleast_2d(np.asarray(X, np.float32))
+        k = min(k, len(self))
+        if self.storage == 'int8':
+            Q = X * self.scale
+            bias = X.dot(self.offset)[:, None]
+        else:
+            Q = X
+            bias = 0.
+
+        best_d = np.empty((len(X), 0), np.float32)
+        best_i = np.empty((len(X), 0), np.int64)
+        for start in range(0, len(self), self.chunk_size):
+            chunk = self.data[start:start + self.chunk_size]
+            chunk = chunk.astype(np.float32)
+            if self.storage == 'int8':
+                chunk += 128
+            d = Q.dot(chunk.T)
+            d += bias
+            if self.metric == 'inner_product':
+                d *= -1
+            else:
+                # |x|^2 - 2 q.x, |q|^2 is added once at the end
+                d *= -2
+                d += self.sq_norms[start:start + len(chunk)]
+
+            ids = np.broadcast_to(
+                np.arange(start, start + len(chunk)), d.shape)
+            best_d = np.concatenate((best_d, d), axis=1)
+            best_i = np.concatenate((best_i, ids), axis=1)
+            if best_d.shape[1] > k:
+                part = np.argpartition(best_d, k - 1, axis=1)[:, :k]
+                best_d = np.take_along_axis(best_d, part, axis=1)
+                best_i = np.take_along_axis(best_i, part, axis=1)
+
+        order = np.argsort(best_d, axis=1, kind='mergesort')
+        best_d = np.take_along_axis(best_d, order, axis=1)
+        best_i = np.take_along_axis(best_i, order, axis=1)
+        if self.metric == 'inner_product':
+            return 1 + best_d, best_i
+        best_d += (X ** 2).sum(axis=1, keepdims=True)
+        return np.sqrt(np.maximum(best_d, 0)), best_i
+
+    def save(self, path):
+        '''saves the index as .npy files in the directory path'''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump({'metric': self.metric}, f)
+        np.save(os.path.join(path, 'data.npy'), self.data)
+        if self.sq_norms is not None:
+            np.save(os.path.join(path, 'sq_norms.npy'), self.sq_norms)
+        if self.storage == 'int8':
+            np.save(os.path.join(path, 'scale.npy'), self.scale)
+            np.save(os.path.join(path, 'offset.npy'), self.offset)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None, chunk_size=4096):
+        '''loads an index saved by save. with mmap_mode='r' the vectors
+        are memory mapped instead of read'''
+        index = cls.__new__(cls)
+        index.chunk_size = chunk_size
+        with open(os.path.join(path, 'index.json')) as f:
+            index.metric = json.load(f)['metric']
+        index.data = np.load(os.path.join(path, 'data.npy'),
+                             mmap_mode=mmap_mode)
+        index.sq_norms = None
+        if index.metric == 'euclidean':
+            index.sq_norms = np.load(os.path.join(path, 'sq_norms.npy'))
+        index.storage = index.data.dtype.name
+        if index.storage == 'int8':
+            index.scale = np.load(os.path.join(path, 'scale.npy'))
+            index.offset = np.load(os.path.join(path, 'offset.npy'))
+        else:
+            index.scale = index.offset = None
+        return index
+
+
+def _nearest_centroids(X, centroids, sq_norms, n=1):
+    '''indices of the n centroids nearest to each row of X, nearest first'''
+    d = X.dot(centroids.T)
+    d *= -2
+    d += sq_norms
+    if n < d.shape[1]:
+        part = np.argpartition(d, n - 1, axis=1)[:, :n]
+        d = np.take_along_axis(d, part, axis=1)
+    else:
+        part = np.broadcast_to(np.arange(d.shape[1]), d.shape)
+    order = np.argsort(d, axis=1, kind='mergesort')
+    return np.take_along_axis(part, order, axis=1)
+
+
+def train_centroids(data, n_lists, n_samples=100000, n_iter=10, seed=0):
+    '''k-means (Lloyd) centroids of at most n_samples random rows of data'''
+    rng = np.random.RandomState(seed)
+    if len(data) > n_samples:
+        data = data[np.sort(rng.choice(len(data), n_samples, replace=False))]
+    sample = np.asarray(data, np.float32)
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+    for _ in range(n_iter):
+        assign = _nearest_centroids(
+            sample, centroids, (centroids ** 2).sum(axis=1))[:, 0]
+        counts = np.bincount(assign, minlength=n_lists)
+        filled = counts > 0
+        starts = np.cumsum(counts) - counts
+        sums = np.add.reduceat(sample[np.argsort(assign, kind='mergesort')],
+                               starts[filled], axis=0)
+        # empty lists keep their centroid
+        centroids[filled] = sums / counts[filled, None]
+    return centroids
+
+
+class IVFIndex(object):
+
+    """Inverted file index built and searched on disk.
+
+    The vectors are clustered into ``n_lists`` lists by k-means centroids,
+    trained on a sample (:func:`train_centroids`), and stored in a
+    directory grouped by list, in ``data.npy`` with their original row in
+    ``ids.npy``. A query searches only the lists of its ``n_probe`` nearest
+    centroids, reading them from the memory mapped files, so neither
+    building nor querying the index needs the vectors in memory: only the
+    centroids, the list offsets and the list of each vector while building.
+
+    :meth:`build` reads ``data`` chunk by chunk, e.g. from a memory mapped
+    ``.npy`` file, in two passes: the first one assigns each vector to a
+    list, the second one writes the vectors to their list. Distances and
+    ``query`` are those of :class:`BruteForceIndex`, with
+    ``'euclidean'`` or ``'inner_product'`` (of L2-normalized vectors,
+    which are assigned to lists by their euclidean distance to the
+    centroids) and ``float32`` or ``float16`` storage. With ``n_probe``
+    equal to ``n_lists`` the search is exact. Queries whose probed lists
+    hold fewer than ``k`` vectors probe more lists.
+
+    Use :meth:`build` and :meth:`load` to make an index.
+
+    """
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @property
+    def nbytes(self):
+        '''memory taken by the index besides the memory mapped files'''
+        return self.centroids.nbytes + self.offsets.nbytes
+
+    @classmethod
+    def build(cls, data, path, n_lists=None, storage='float32',
+              metric='euclidean', n_probe=16, n_samples=100000, n_iter=10,
+              chunk_size=65536, seed=0):
+        '''builds the index of the (N, D)-shaped data in the directory
+        path and returns it, loaded from there. n_lists defaults to
+        sqrt(N)'''
+        if storage not in ('float32', 'float16'):
+            raise ValueError('unknown storage {} for an ivf index, '
+                             'expected float32 or float16'.format(storage))
+        if metric not in METRICS:
+            raise ValueError('unknown metric {}, expected one of {}'.format(
+                metric, ', '.join(METRICS)))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        n, dim = data.shape
+        if n_lists is None:
+            n_lists = int(np.sqrt(n))
+        n_lists = max(1, min(n_lists, n, n_samples))
+
+        centroids = train_centroids(data, n_lists, n_samples, n_iter, seed)
+        c_sq_norms = (centroids ** 2).sum(axis=1)
+        # first pass: the list of each vector
+        assign = np.empty(n, np.int32)
+        for start in range(0, n, chunk_size):
+            chunk = np.asarray(data[start:start + chunk_size], np.float32)
+            assign[start:start + len(chunk)] = _nearest_centroids(
+                chunk, centroids, c_sq_norms)[:, 0]
+        offsets = np.zeros(n_lists + 1, np.int64)
+        np.cumsum(np.bincount(assign, minlength=n_lists), out=offsets[1:])
+
+        # second pass: each chunk is sorted by list and appended to the
+        # end of the lists written so far
+        out = np.lib.format.open_memmap(os.path.join(path, 'data.npy'), 'w+',
+                                        np.dtype(storage), (n, dim))
+        ids = np.lib.format.open_memmap(os.path.join(path, 'ids.npy'), 'w+',
+                                        np.int64, (n, ))
+        ends = offsets[:-1].copy()
+        for start in range(0, n, chunk_size):
+            chunk_assign = assign[start:start + chunk_size]
+            order = np.argsort(chunk_assign, kind='mergesort')
+            sorted_assign = chunk_assign[order]
+            counts = np.bincount(chunk_assign, minlength=n_lists)
+            rank = np.arange(len(order)) - (np.cumsum(counts) - counts)[
+                sorted_assign]
+            positions = ends[sorted_assign] + rank
+            out[positions] = np.asarray(
+                data[start:start + chunk_size])[order].astype(storage)
+            ids[positions] = start + order
+            ends += counts
+
+        if metric == 'euclidean':
+            # squared norms of the vectors as they are stored
+            sq_norms = np.lib.format.open_memmap(
+                os.path.join(path, 'sq_norms.npy'), 'w+', np.float32, (n, ))
+            for start in range(0, n, chunk_size):
+                chunk = out[start:start + chunk_size].astype(np.float32)
+                sq_norms[start:start + len(chunk)] = (chunk ** 2).sum(axis=1)
+            sq_norms.flush()
+            del sq_norms
+        out.flush()
+        ids.flush()
+        del out, ids
+        np.save(os.path.join(path, 'centroids.npy'), centroids)
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump({'metric': metric, 'n_probe': n_probe}, f)
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r', chunk_size=16384):
+        '''loads an index built in (or saved to) path. the vectors, their
+        ids and norms are memory mapped with mmap_mode'''
+        index = cls.__new__(cls)
+        index.path = path
+        index.chunk_size = chunk_size
+        with open(os.path.join(path, 'index.json')) as f:
+            config = json.load(f)
+        index.metric = config['metric']
+        index.n_probe = config['n_probe']
+        index.data = np.load(os.path.join(path, 'data.npy'),
+                             mmap_mode=mmap_mode)
+        index.storage = index.data.dtype.name
+        index.ids = np.load(os.path.join(path, 'ids.npy'),
+                            mmap_mode=mmap_mode)
+        index.sq_norms = None
+        if index.metric == 'euclidean':
+            index.sq_norms = np.load(os.path.join(path, 'sq_norms.npy'),
+                                     mmap_mode=mmap_mode)
+        index.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        index.c_sq_norms = (index.centroids ** 2).sum(axis=1)
+        index.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        return index
+
+    def save(self, path):
+        '''copies the files of the index to the directory path'''
+        if os.path.realpath(path) == os.path.realpath(self.path):
+            return
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in os.listdir(self.path):
+            shutil.copyfile(os.path.join(self.path, name),
+                            os.path.join(path, name))
+
+    def _search_list(self, X, rows, lst, best_d, best_i, k):
+        # merges the vectors of list lst into the k best of the queries rows
+        start, end = self.offsets[lst], self.offsets[lst + 1]
+        Q = X[rows]
+        for chunk_start in range(start, end, self.chunk_size):
+            chunk_end = min(chunk_start + self.chunk_size, end)
+            chunk = self.data[chunk_start:chunk_end].astype(np.float32)
+            d = Q.dot(chunk.T)
+            if self.metric == 'inner_product':
+                d *= -1
+            else:
+                # |x|^2 - 2 q.x, |q|^2 is added once at the end
+                d *= -2
+                d += self.sq_norms[chunk_start:chunk_end]
+            ids = np.broadcast_to(self.ids[chunk_start:chunk_end], d.shape)
+            d = np.concatenate((best_d[rows], d), axis=1)
+            ids = np.concatenate((best_i[rows], ids), axis=1)
+            part = np.argpartition(d, k - 1, axis=1)[:, :k]
+            best_d[rows] = np.take_along_axis(d, part, axis=1)
+            best_i[rows] = np.take_along_axis(ids, part, axis=1)
+
+    def query(self, X, k=1, n_probe=None):
+        '''returns the distances and the indices of the (approximate) k
+        nearest neighbors of each row of X, both (B, k)-shaped and sorted by
+        distance, searching the n_probe nearest lists of each query'''
+        X = np.atleast_2d(np.asarray(X, np.float32))
+        k = min(k, len(self))
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        # lists of each query, nearest first
+        lists = _nearest_centroids(X, self.centroids, self.c_sq_norms,
+                                   self.n_lists)
+        best_d = np.full((len(X), k), np.inf, np.float32)
+        best_i = np.full((len(X), k), -1, np.int64)
+        rows = np.arange(len(X))
+        probed = 0
+        while len(rows):
+            probe = lists[rows, probed:probed + n_probe]
+            # each list is read once for all of the queries that probe it
+            for lst in np.unique(probe):
+                self._search_list(X, rows[(probe == lst).any(axis=1)], lst,
+                                  best_d, best_i, k)
+            probed += n_probe
+            if probed >= self.n_lists:
+                break
+            rows = rows[(best_i[rows] < 0).any(axis=1)]
+
+        order = np.argsort(best_d, axis=1, kind='mergesort')
+        best_d = np.take_along_axis(best_d, order, axis=1)
+        best_i = np.take_along_axis(best_i, order, axis=1)
+        if self.metric == 'inner_product':
+            return 1 + best_d, best_i
+        best_d += (X ** 2).sum(axis=1, keepdims=True)
+        return np.sqrt(np.maximum(best_d, 0)), best_i
+
+
+REDUCTIONS = ('pca', 'gaussian', 'sparse')
+
+
+class LinearProjection(object):
+
+    """Linear dimensionality reduction ``(X - mean) @ matrix``.
+
+    Made by :func:`fit_pca` or :func:`random_projection`, and applied to
+    both the indexed activations and the queries, so that the index works
+    with ``n_components`` instead of all the hidden units.
+
+    Args:
+        mean (numpy.ndarray): :math:`(D, )`-shaped vector subtracted
+            first.
+        matrix (numpy.ndarray): :math:`(D, n\\_components)`-shaped
+            projection.
+
+    """
+
+    def __init__(self, mean, matrix):
+        self.mean = np.asarray(mean, np.float32)
+        self.matrix = np.ascontiguousarray(matrix, np.float32)
+
+    @property
+    def n_components(self):
+        return self.matrix.shape[1]
+
+    def __call__(self, X, chunk_size=8192, out=None):
+        '''projects the rows of X chunk by chunk, into out if it is given
+        (e.g. a memory mapped array)'''
+        Y = out
+        if Y is None:
+            Y = np.empty((len(X), self.n_components), np.float32)
+        for start in range(0, len(X), chunk_size):
+            chunk = np.asarray(X[start:start + chunk_size], np.float32)
+            Y[start:start + chunk_size] = (chunk - self.mean).dot(self.matrix)
+        return Y
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, matrix=self.matrix)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['mean'], f['matrix'])
+
+
+def fit_pca(data, n_components, n_samples=10000, seed=0):
+    '''PCA fitted on at most n_samples random rows of data'''
+    rng = np.random.RandomState(seed)
+    if len(data) > n_samples:
+        data = data[np.sort(rng.choice(len(data), n_samples, replace=False))]
+    data = np.asarray(data, np.float64)
+    mean = data.mean(axis=0)
+    _, _, vt = np.linalg.svd(data - mean, full_matrices=False)
+    return LinearProjection(mean, vt[:n_components].T)
+
+
+def random_projection(n_features, n_components, kind='gaussian', seed=0):
+    '''gaussian random projection, or the sparse one of Li et al. (2006)
+    with a density of 1 / sqrt(n_features), both scaled to preserve
+    distances in expectation'''
+    rng = np.random.RandomState(seed)
+    if kind == 'gaussian':
+        matrix = rng.normal(0, 1. / np.sqrt(n_components),
+                            (n_features, n_components))
+    elif kind == 'sparse':
+        density = 1. / np.sqrt(n_features)
+        signs = rng.choice([-1., 0., 1.], (n_features, n_components),
+                           p=[density / 2, 1 - density, density / 2])
+        matrix = signs / np.sqrt(density * n_components)
+    else:
+        raise ValueError('unknown random projection {}'.format(kind))
+    return LinearProjection(np.zeros(n_features), matrix)
+
+
+def make_reduction(data, reduction, n_components, seed=0):
+    '''returns the projection named by reduction ('pca', 'gaussian' or
+    'sparse') for data, or None if data has at most n_components
+    dimensions'''
+    n_features = data.shape[1]
+    if n_features <= n_components:
+        return None
+    if reduction == 'pca':
+        return fit_pca(data, n_components, seed=seed)
+    return random_projection(n_features, n_components, reduction, seed=seed)
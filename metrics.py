@@ -0,0 +1,359 @@
+import os
+import json
+
+import numpy as np
+
+'''calibration metrics (ECE, MCE, Brier score, NLL) that are accumulated
+batch by batch, for the softmax of a model as well as for DkNN
+credibility, and the evaluation report of run_dknn.py, streamed to disk'''
+
+
+class CalibrationMetrics(object):
+
+    """Calibration metrics accumulated over batches of predictions.
+
+    Each prediction is put into one of ``n_bins`` equal-width confidence
+    bins with :func:`numpy.digitize`, and only per-bin counts, confidence
+    sums and accuracy sums are kept (:func:`numpy.bincount`). Memory does
+    not grow with the number of predictions, and all metrics are computed
+    in a single pass.
+
+    :meth:`update` takes full class distributions (e.g. a temperature
+    scaled softmax) and also accumulates the Brier score and the NLL.
+    :meth:`update_confidence` only needs the confidence of the predicted
+    class and whether it was correct, which is what DkNN credibility
+    provides.
+
+    Args:
+        n_bins (int): Number of confidence bins.
+
+    """
+
+    def __init__(self, n_bins=15):
+        self.n_bins = n_bins
+        self.boundaries = np.linspace(0, 1, n_bins + 1)
+        self.reset()
+
+    def reset(self):
+        self.counts = np.zeros(self.n_bins, np.int64)
+        self.confidence_sums = np.zeros(self.n_bins)
+        self.correct_sums = np.zeros(self.n_bins)
+        self.n_probs = 0
+        self.brier_sum = 0.
+        self.nll_sum = 0.
+
+    def update_confidence(self, confidences, correct):
+        confidences = np.asarray(confidences, np.float64).ravel()
+        correct = np.asarray(correct, np.float64).ravel()
+        bins = np.digitize(confidences, self.boundaries[1:-1], right=True)
+        self.counts += np.bincount(bins, minlength=self.n_bins)
+        self.confidence_sums += np.bincount(
+            bins, confidences, minlength=self.n_bins)
+        self.correct_sums += np.bincount(
+            bins, correct, minlength=self.n_bins)
+
+    def update(self, probs, labels):
+        probs = np.asarray(probs, np.float64)
+        labels = np.asarray(labels).ravel()
+        rows = np.arange(len(labels))
+        predictions = probs.argmax(axis=1)
+        self.update_confidence(probs[rows, predictions],
+                               predictions == labels)
+
+        p_true = probs[rows, labels]
+        # sum_c (p_c - [c == y])^2 = sum_c p_c^2 - 2 p_y + 1
+        self.brier_sum += float(
+            ((probs ** 2).sum(axis=1) - 2 * p_true + 1).sum())
+        self.nll_sum += float(
+            -np.log(np.maximum(p_true, np.finfo(np.float64).tiny)).sum())
+        self.n_probs += len(labels)
+
+    @property
+    def n_total(self):
+        return int(self.counts.sum())
+
+    @property
+    def accuracy(self):
+        return self.correct_sums.sum() / max(self.n_total, 1)
+
+    @property
+    def ece(self):
+        gaps = np.abs(self.confidence_sums - self.correct_sums)
+        return gaps.sum() / max(self.n_total, 1)
+
+    @property
+    def mce(self):
+        filled = self.counts > 0
+        if not filled.any():
+            return 0.
+        gaps = np.abs(self.confidence_sums - self.correct_sums)[filled]
+        return (gaps / self.counts[filled]).max()
+
+    @property
+    def brier(self):
+        if self.n_probs == 0:
+            return None
+        return self.brier_sum / self.n_probs
+
+    @property
+    def nll(self):
+        if self.n_probs == 0:
+            return None
+        return self.nll_sum / self.n_probs
+
+    def reliability(self):
+        '''returns the data of a reliability diagram: the bin boundaries,
+        the mean confidence and the accuracy of each bin (nan when the bin
+        is empty) and the bin counts'''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            confidence = self.confidence_sums / self.counts
+            accuracy = self.correct_sums / self.counts
+        return self.boundaries, confidence, accuracy, self.counts.copy()
+
+    def summary(self):
+        return {'n': self.n_total, 'accuracy': float(self.accuracy),
+                'ece': float(self.ece), 'mce': float(self.mce),
+                'brier': self.brier, 'nll': self.nll}
+
+
+class ColumnWriter(object):
+
+    """Writes per-example columns to a directory, batch by batch.
+
+    Each column is appended to its own raw binary file as batches arrive,
+    and ``columns.json`` records the dtype of each column and the number
+    of rows. Nothing is kept in memory between batches, and each column
+    can be read on its own, memory mapped, with :func:`load_columns`.
+
+    Args:
+        path (str): Directory of the column files.
+        columns (list of tuple): ``(name, dtype)`` of each column.
+
+    """
+
+    def __init__(self, path, columns):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.columns = [(name, np.dtype(dtype)) for name, dtype in columns]
+        self.files = {name: open(os.path.join(path, name + '.bin'), 'wb')
+                      for name, _ in self.columns}
+        self.n_rows = 0
+
+    def write(self, **values):
+        n_rows = None
+        for name, dtype in self.columns:
+            column = np.asarray(values[name], dtype).ravel()
+            if n_rows is not None and len(column) != n_rows:
+                raise ValueError('column {} has {} rows, expected {}'.format(
+                    name, len(column), n_rows))
+            n_rows = len(column)
+            column.tofile(self.files[name])
+        self.n_rows += n_rows
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        with open(os.path.join(self.path, 'columns.json'), 'w') as f:
+            json.dump({'n_rows': self.n_rows,
+                       'columns': [[name, dtype.str]
+                                   for name, dtype in self.columns]}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_columns(path, mmap_mode='r'):
+    '''returns the columns written by ColumnWriter to path, as a dict of
+    arrays that are memory mapped with mmap_mode (read if it is None)'''
+    with open(os.path.join(path, 'columns.json')) as f:
+        header = json.load(f)
+    n_rows = header['n_rows']
+    columns = {}
+    for name, dtype in header['columns']:
+        filename = os.path.join(path, name + '.bin')
+        if mmap_mode is None or n_rows == 0:  # empty files can't be mapped
+            columns[name] = np.fromfile(filename, dtype, n_rows)
+        else:
+            columns[name] = np.memmap(filename, dtype, mmap_mode,
+                                      shape=(n_rows, ))
+    return columns
+
+
+def _nan_to_none(values):
+    return [None if np.isnan(v) else float(v) for v in values]
+
+
+class EvaluationReport(object):
+
+    """Evaluation of a model with and without DkNN, accumulated by batch.
+
+    For each example, :meth:`update` takes the label, the length, the
+    prediction and confidence of the model, and the DkNN prediction,
+    credibility and confidence. With ``path``, these are streamed to
+    column files (:class:`ColumnWriter`), so the distribution of
+    credibility can be studied later without running the model again.
+
+    Only fixed-size aggregates are kept in memory:
+
+    * the calibration of the model confidence and of the DkNN credibility
+      (:class:`CalibrationMetrics`, whose bins give the accuracy per
+      credibility bin),
+    * the accuracy of both per class and per length bucket,
+    * the examples and the correct ones per ``1 / n_thresholds`` wide
+      bin of credibility (and of model confidence), from which
+      :meth:`coverage` gives the fraction of examples kept and their
+      accuracy for every rejection threshold.
+
+    The rejection curves and credibility bins assume that higher scores
+    mean more trust: examples whose credibility is below a threshold are
+    rejected. DkNN credibility, calibrated or not, rises with the share of
+    neighbors that agree with the prediction (see ``DkNN._calibrated``).
+
+    Args:
+        path (str): Directory the per-example columns and ``summary.json``
+            are written to, or ``None`` to only keep the aggregates.
+        n_bins (int): Number of calibration bins.
+        n_thresholds (int): Number of rejection thresholds in ``(0, 1]``.
+        length_buckets (tuple of int): Lower bounds of the length buckets
+            after the first one, which starts at 0.
+
+    """
+
+    COLUMNS = (('index', np.int64), ('label', np.int32),
+               ('length', np.int32), ('reg_pred', np.int32),
+               ('reg_conf', np.float32), ('knn_pred', np.int32),
+               ('knn_cred', np.float32), ('knn_conf', np.float32))
+
+    def __init__(self, path=None, n_bins=15, n_thresholds=100,
+                 length_buckets=(8, 16, 32, 64, 128, 256)):
+        self.path = path
+        self.writer = None
+        if path is not None:
+            self.writer = ColumnWriter(path, self.COLUMNS)
+        self.reg_metrics = CalibrationMetrics(n_bins)
+        self.knn_metrics = CalibrationMetrics(n_bins)
+        self.length_buckets = np.asarray(length_buckets, np.int64)
+        self.n_thresholds = n_thresholds
+        # examples, correct model predictions and correct dknn predictions
+        self.class_counts = np.zeros((0, 3), np.int64)
+        self.bucket_counts = np.zeros((len(length_buckets) + 1, 3), np.int64)
+        # examples and correct predictions per threshold bin
+        self.reg_thresholds = np.zeros((n_thresholds + 1, 2), np.int64)
+        self.knn_thresholds = np.zeros((n_thresholds + 1, 2), np.int64)
+        self.n_seen = 0
+
+    @staticmethod
+    def _group_counts(groups, n_groups, *correct):
+        return np.stack([np.bincount(groups, minlength=n_groups)] +
+                        [np.bincount(groups, c, minlength=n_groups)
+                         for c in correct], axis=1).astype(np.int64)
+
+    def _threshold_bins(self, scores):
+        # bin i holds the scores in [i / n, (i + 1) / n), so the scores at
+        # least i / n are those of bins i and up. the epsilon keeps scores
+        # like 0.29 (a fraction of neighbors) from rounding to the bin below
+        bins = np.floor(scores * self.n_thresholds + 1e-9).astype(np.int64)
+        return np.clip(bins, 0, self.n_thresholds)
+
+    def update(self, label, length, reg_pred, reg_conf, knn_pred, knn_cred,
+               knn_conf, index=None):
+        label = np.asarray(label, np.int64).ravel()
+        length = np.asarray(length, np.int64).ravel()
+        reg_pred = np.asarray(reg_pred, np.int64).ravel()
+        knn_pred = np.asarray(knn_pred, np.int64).ravel()
+        reg_conf = np.asarray(reg_conf, np.float64).ravel()
+        knn_cred = np.asarray(knn_cred, np.float64).ravel()
+        if index is None:
+            index = np.arange(self.n_seen, self.n_seen + len(label))
+        reg_correct = reg_pred == label
+        knn_correct = knn_pred == label
+
+        self.reg_metrics.update_confidence(reg_conf, reg_correct)
+        self.knn_metrics.update_confidence(knn_cred, knn_correct)
+
+        n_class = int(max(label.max(initial=0), reg_pred.max(initial=0),
+                          knn_pred.max(initial=0))) + 1
+        if n_class > len(self.class_counts):
+            grown = np.zeros((n_class, 3), np.int64)
+            grown[:len(self.class_counts)] = self.class_counts
+            self.class_counts = grown
+        self.class_counts += self._group_counts(
+            label, len(self.class_counts), reg_correct, knn_correct)
+        buckets = np.digitize(length, self.length_buckets)
+        self.bucket_counts += self._group_counts(
+            buckets, len(self.bucket_counts), reg_correct, knn_correct)
+        self.reg_thresholds += self._group_counts(
+            self._threshold_bins(reg_conf), self.n_thresholds + 1,
+            reg_correct)
+        self.knn_thresholds += self._group_counts(
+            self._threshold_bins(knn_cred), self.n_thresholds + 1,
+            knn_correct)
+        self.n_seen += len(label)
+
+        if self.writer is not None:
+            self.writer.write(index=index, label=label, length=length,
+                              reg_pred=reg_pred, reg_conf=reg_conf,
+                              knn_pred=knn_pred, knn_cred=knn_cred,
+                              knn_conf=knn_conf)
+
+    def coverage(self, dknn=True):
+        '''returns the rejection thresholds, the fraction of the examples
+        whose credibility (model confidence if dknn is False) is at least
+        each threshold, and the accuracy on those examples (nan if there
+        is none)'''
+        counts = self.knn_thresholds if dknn else self.reg_thresholds
+        kept = counts[::-1].cumsum(axis=0)[::-1]
+        thresholds = np.arange(self.n_thresholds + 1) / self.n_thresholds
+        with np.errstate(invalid='ignore', divide='ignore'):
+            accuracy = kept[:, 1] / kept[:, 0]
+        return thresholds, kept[:, 0] / max(self.n_seen, 1), accuracy
+
+    def summary(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            per_class = self.class_counts[:, 1:] / self.class_counts[:, :1]
+            per_bucket = self.bucket_counts[:, 1:] / self.bucket_counts[:, :1]
+        lower = [0] + self.length_buckets.tolist()
+        upper = self.length_buckets.tolist() + [None]
+        boundaries, confidence, accuracy, counts = \
+            self.knn_metrics.reliability()
+        thresholds, knn_coverage, knn_accuracy = self.coverage()
+        _, reg_coverage, reg_accuracy = self.coverage(dknn=False)
+        return {
+            'n': self.n_seen,
+            'reg': self.reg_metrics.summary(),
+            'knn': self.knn_metrics.summary(),
+            'per_class': [
+                {'class': c, 'n': int(self.class_counts[c, 0]),
+                 'reg_accuracy': r, 'knn_accuracy': k}
+                for c, (r, k) in enumerate(
+                    zip(*map(_nan_to_none, per_class.T)))],
+            'per_length': [
+                {'min_length': lo, 'max_length': hi,
+                 'n': int(self.bucket_counts[b, 0]),
+                 'reg_accuracy': r, 'knn_accuracy': k}
+                for b, (lo, hi, r, k) in enumerate(
+                    zip(lower, upper, *map(_nan_to_none, per_bucket.T)))],
+            'per_credibility': {
+                'boundaries': boundaries.tolist(),
+                'credibility': _nan_to_none(confidence),
+                'accuracy': _nan_to_none(accuracy),
+                'n': counts.tolist()},
+            'coverage': {
+                'threshold': thresholds.tolist(),
+                'knn_coverage': knn_coverage.tolist(),
+                'knn_accuracy': _nan_to_none(knn_accuracy),
+                'reg_coverage': reg_coverage.tolist(),
+                'reg_accuracy': _nan_to_none(reg_accuracy)},
+        }
+
+    def close(self):
+        '''closes the column files and writes summary.json next to them'''
+        if self.writer is None:
+            return
+        self.writer.close()
+        with open(os.path.join(self.path, 'summary.json'), 'w') as f:
+            json.dump(self.summary(), f, indent=2)
@@ -1,9 +1,14 @@
+import contextlib
+
 import numpy as np
 
 import chainer
 import chainer.functions as F
 import chainer.links as L
 from chainer import reporter
+from chainer.backends import cuda
+
+from nlp_utils import SequenceBatch, concat_sequences
 
 embed_init = chainer.initializers.Uniform(.25)
 
@@ -25,7 +30,9 @@ def sequence_embed(embed, xs, dropout=0.):
             or :class:`~chainer.links.EmbedID` link.
         xs (list of :class:`~chainer.Variable` or :class:`numpy.ndarray` or \
         :class:`cupy.ndarray`): i-th element in the list is an input variable,
-            which is a :math:`(L_i, )`-shaped int array.
+            which is a :math:`(L_i, )`-shaped int array. A
+            :class:`~nlp_utils.SequenceBatch` is used without concatenating
+            it again.
         dropout (float): Dropout ratio.
 
     Returns:
@@ -34,14 +41,39 @@ def sequence_embed(embed, xs, dropout=0.):
         float array. :math:`(N)` is the number of dimensions of word embedding.
 
     """
-    x_len = [len(x) for x in xs]
-    x_section = np.cumsum(x_len[:-1])
-    ex = embed(F.concat(xs, axis=0))
+    if isinstance(xs, SequenceBatch):
+        x_section = xs.sections
+        ex = embed(xs.tokens)
+    else:
+        x_len = [len(x) for x in xs]
+        x_section = np.cumsum(x_len[:-1])
+        ex = embed(F.concat(xs, axis=0))
     ex = F.dropout(ex, ratio=dropout)
     exs = F.split_axis(ex, x_section, 0)
     return exs
 
 
+def pad_sequences(xs):
+    """Returns a :math:`(B, L)`-shaped block of ``xs`` padded with ``-1``
+
+    A :class:`~nlp_utils.SequenceBatch` already carries its padded block,
+    so it is returned as is.
+
+    """
+    if isinstance(xs, SequenceBatch):
+        return xs.block
+    return chainer.dataset.convert.concat_examples(xs, padding=-1)
+
+
+def sequence_lengths(xp, xs):
+    """Returns the lengths of ``xs`` as a :math:`(B, 1, 1)`-shaped array"""
+    if isinstance(xs, SequenceBatch):
+        x_len = xs.xp_lengths
+    else:
+        x_len = xp.array([len(x) for x in xs], np.int32)
+    return x_len[:, None, None]
+
+
 def block_embed(embed, x, dropout=0.):
     """Embedding function followed by convolution
 
@@ -69,6 +101,104 @@ def block_embed(embed, x, dropout=0.):
     return e
 
 
+@contextlib.contextmanager
+def inference_mode(dtype=None):
+    """Context for running models when no gradient is needed.
+
+    Sets ``chainer.config.train`` to ``False`` and disables backprop, so
+    no computational graph is kept and the intermediate activations are
+    freed as soon as they are used. With ``dtype``, ``chainer.config.dtype``
+    is set as well, e.g. to the dtype a model was cast to by
+    :func:`cast_params`.
+
+    Args:
+        dtype: ``None`` to keep ``chainer.config.dtype``, or
+            ``numpy.float32`` or ``numpy.float16``.
+
+    """
+    with chainer.using_config('train', False), chainer.no_backprop_mode():
+        if dtype is None:
+            yield
+        else:
+            with chainer.using_config('dtype', np.dtype(dtype)):
+                yield
+
+
+def cast_params(link, dtype):
+    """Casts the parameters of ``link`` to ``dtype``, in place.
+
+    With ``numpy.float16`` the model takes half of the memory and, on GPUs
+    with fast half precision, runs faster. It is meant for inference (see
+    :func:`inference_mode`): the probabilities are still computed in
+    float32 by :func:`scaled_softmax`.
+
+    """
+    for param in link.params():
+        if param.data is not None:
+            param.data = param.data.astype(dtype, copy=False)
+    return link
+
+
+def param_dtype(link):
+    """Returns the dtype of the parameters of ``link``"""
+    return next(link.params()).dtype
+
+
+def scaled_softmax(x, temperature=1.):
+    """Softmax of temperature scaled logits, as a raw float32 array.
+
+    Used for inference only, so it works on the raw logits without
+    building a graph: the logits are scaled and normalized in place on a
+    single float32 working copy, also for float16 models.
+
+    Args:
+        x (:class:`~chainer.Variable` or :class:`numpy.ndarray` or \
+        :class:`cupy.ndarray`): :math:`(B, C)`-shaped logits.
+        temperature (float): The logits are divided by this value.
+
+    Returns:
+        :class:`numpy.ndarray` or :class:`cupy.ndarray`: Probabilities.
+
+    """
+    x = chainer.as_variable(x).data
+    xp = cuda.get_array_module(x)
+    y = x.astype(np.float32)
+    if temperature != 1.:
+        y *= 1. / temperature
+    y -= y.max(axis=1, keepdims=True)
+    xp.exp(y, out=y)
+    y /= y.sum(axis=1, keepdims=True)
+    return y
+
+
+def export_layers(layers, layer_ids=None, dtype=np.float32):
+    """Copies DkNN layers to the host as contiguous arrays.
+
+    Layers are cast to ``dtype`` on the device before the copy, so only
+    ``dtype``-sized values are transferred, and only the layers in
+    ``layer_ids`` are copied at all.
+
+    Args:
+        layers (list of :class:`~chainer.Variable`): The :math:`(B, N_l)`
+            -shaped activations returned by ``predict(xs, dknn=True)``.
+        layer_ids (list of int): Ids of the layers to copy, all of them
+            if ``None``.
+        dtype: ``numpy.float32`` or ``numpy.float16``.
+
+    Returns:
+        list of numpy.ndarray: One C-contiguous :math:`(B, N_l)`-shaped
+        array for each layer in ``layer_ids``.
+
+    """
+    if layer_ids is None:
+        layer_ids = range(len(layers))
+    exported = []
+    for i in layer_ids:
+        h = chainer.as_variable(layers[i]).data.astype(dtype, copy=False)
+        exported.append(np.ascontiguousarray(cuda.to_cpu(h)))
+    return exported
+
+
 class TextClassifier(chainer.Chain):
 
     """A classifier using a given encoder.
@@ -82,6 +212,10 @@ class TextClassifier(chainer.Chain):
              Output is a variable whose shape is "(batchsize, n_units)".
          n_class (int): The number of classes to be predicted.
 
+     The probabilities returned by ``predict(xs, softmax=True)`` are
+     scaled by ``temperature``, which is 1 until a temperature fitted by
+     scaling.py is set.
+
      """
 
     def __init__(self, encoder, n_class, dropout=0.1):
@@ -93,6 +227,7 @@ class TextClassifier(chainer.Chain):
             else:
                 self.output = L.Linear(encoder.out_units, n_class)
         self.dropout = dropout
+        self.temperature = 1.
         self.n_dknn_layers = self.encoder.n_dknn_layers
 
     def __call__(self, xs, ys):
@@ -108,7 +243,7 @@ class TextClassifier(chainer.Chain):
     # returns gradient w.r.t to each word
     def get_onehot_grad(self, xs, ys=None):
         if ys is None:
-            with chainer.using_config('train', False):
+            with inference_mode():
                 ys = self.predict(xs, argmax=True)
                 ys = F.expand_dims(ys, axis=1)
                 ys = [y for y in ys]
@@ -133,6 +268,15 @@ class TextClassifier(chainer.Chain):
             onehot_grad = [x[:l] for x, l in zip(onehot_grad, lengths)]
         return onehot_grad
 
+    # inference only export of the dknn layers: no graph is built (see
+    # inference_mode), in the dtype of the parameters. returns the
+    # probabilities with a host array of dtype for each layer in layer_ids
+    # (see export_layers)
+    def export_activations(self, xs, layer_ids=None, dtype=np.float32):
+        with inference_mode(param_dtype(self)):
+            probs, dknn_layers = self.predict(xs, softmax=True, dknn=True)
+        return probs, export_layers(dknn_layers, layer_ids, dtype)
+
     # if using dknn, return prediction and activations for each layer
     # o/w, just return prediction
     def predict(self, xs, softmax=False, argmax=False, dknn=False,
@@ -147,7 +291,7 @@ class TextClassifier(chainer.Chain):
             encodings = F.dropout(encodings, ratio=self.dropout)
         outputs = self.output(encodings)
         if softmax:
-            outputs = F.softmax(outputs).data
+            outputs = scaled_softmax(outputs, self.temperature)
         elif argmax:
             outputs = self.xp.argmax(outputs.data, axis=1)
         if dknn:
@@ -160,7 +304,8 @@ class SNLIClassifier(chainer.Chain):
     ''' Uses a BiLSTM to read the premise and hypothesis, and then
     combines the results of the two last states and puts them through
     FC layers. The concatenation of the final hidden states is inspired
-    from infersent '''
+    from infersent. Probabilities from predict are scaled by temperature
+    like in TextClassifier '''
     def __init__(self, encoder, n_class=3, n_layers=3, dropout=0.1):
         super(SNLIClassifier, self).__init__()
         with self.init_scope():
@@ -173,6 +318,7 @@ class SNLIClassifier(chainer.Chain):
                 self.output = L.Linear(encoder.out_units * 4, n_class)
 
         self.dropout = dropout
+        self.temperature = 1.
         self.n_dknn_layers = self.mlp.n_dknn_layers + 1
 
     def __call__(self, xs, ys):
@@ -187,18 +333,21 @@ class SNLIClassifier(chainer.Chain):
 
     def get_onehot_grad(self, xs, ys=None):
         if ys is None:
-            with chainer.using_config('train', False):
+            with inference_mode():
                 ys = self.predict(xs, argmax=True)
-        u, exs_prem = self.encoder.get_grad(xs[0])
-        v, exs_hypo = self.encoder.get_grad(xs[1])
+        # premises and hypotheses go through the encoder as one batch
+        n_prem = len(xs[0])
+        encodings, exs = self.encoder.get_grad(concat_sequences(xs[0], xs[1]))
+        u, v = F.split_axis(encodings, [n_prem], axis=0)
         encodings = F.concat((u, v, F.absolute(u-v), u*v), axis=1)
         outputs = self.output(self.mlp(encodings, no_dropout=True))
         loss = F.softmax_cross_entropy(outputs, ys)
 
-        exs = exs_hypo
+        # only the hypothesis words are scored
         lengths = [len(x) for x in xs[1]]
 
         if isinstance(exs, tuple):
+            exs = exs[n_prem:]
             exs_grad = chainer.grad([loss], exs)
             ex_sections = np.cumsum([ex.shape[0] for ex in exs[:-1]])
             exs = F.concat(exs, axis=0)
@@ -206,18 +355,47 @@ class SNLIClassifier(chainer.Chain):
             onehot_grad = F.sum(exs_grad * exs, axis=1)
             onehot_grad = F.split_axis(onehot_grad, ex_sections, axis=0)
         else:
-            exs_grad = chainer.grad([loss], [exs])[0]
+            exs_grad = chainer.grad([loss], [exs])[0][n_prem:]
+            exs = exs[n_prem:]
             # (batch_size, n_dim, max_length, 1)
             assert exs_grad.shape == exs.shape
             onehot_grad = F.squeeze(F.sum(exs_grad * exs, 1), 2)
             onehot_grad = [x[:l] for x, l in zip(onehot_grad, lengths)]
         return onehot_grad
 
+    # inference only export of the dknn layers: no graph is built (see
+    # inference_mode), in the dtype of the parameters. returns the
+    # probabilities with a host array of dtype for each layer in layer_ids
+    # (see export_layers)
+    def export_activations(self, xs, layer_ids=None, dtype=np.float32):
+        with inference_mode(param_dtype(self)):
+            probs, dknn_layers = self.predict(xs, softmax=True, dknn=True)
+        return probs, export_layers(dknn_layers, layer_ids, dtype)
+
+    # encodes premises, e.g. to share one premise encoding between many
+    # hypotheses through predict(..., premise_encoding=u)
+    def encode_premise(self, premises, no_dropout=False):
+        return self.encoder(premises, dknn=False, no_dropout=no_dropout)
+
+    # xs is a pair (premises, hypotheses). a single premise, or a premise
+    # encoding u of shape (1, n_units) given as premise_encoding (xs[0] is
+    # then ignored), is encoded once and broadcast to all hypotheses
     def predict(self, xs, softmax=False, argmax=False, dknn=False,
-                no_dropout=False):
+                no_dropout=False, premise_encoding=None):
         dknn_layers = []
-        u = self.encoder(xs[0], dknn=False, no_dropout=no_dropout)
-        v = self.encoder(xs[1], dknn=False, no_dropout=no_dropout)
+        if premise_encoding is None and len(xs[0]) == len(xs[1]):
+            # encode premises and hypotheses in a single encoder call
+            n_prem = len(xs[0])
+            h = self.encoder(concat_sequences(xs[0], xs[1]),
+                             dknn=False, no_dropout=no_dropout)
+            u, v = F.split_axis(h, [n_prem], axis=0)
+        else:
+            u = premise_encoding
+            if u is None:
+                assert len(xs[0]) == 1
+                u = self.encode_premise(xs[0], no_dropout=no_dropout)
+            v = self.encoder(xs[1], dknn=False, no_dropout=no_dropout)
+            u = F.broadcast_to(u, v.shape)
         # concatenate results as done in infersent
         encodings = F.concat((u, v, F.absolute(u-v), u*v), axis=1)
         dknn_layers = [encodings]
@@ -232,7 +410,7 @@ class SNLIClassifier(chainer.Chain):
 
         outputs = self.output(outputs)
         if softmax:
-            outputs = F.softmax(outputs).data
+            outputs = scaled_softmax(outputs, self.temperature)
         elif argmax:
             outputs = self.xp.argmax(outputs.data, axis=1)
         if dknn:
@@ -372,7 +550,7 @@ class CNNEncoder(chainer.Chain):
         self.n_dknn_layers = self.mlp.n_dknn_layers + 1
 
     def get_grad(self, xs):
-        x_block = chainer.dataset.convert.concat_examples(xs, padding=-1)
+        x_block = pad_sequences(xs)
         ex_block = block_embed(self.embed, x_block, dropout=0.)
         h_w3 = F.max(self.cnn_w3(ex_block), axis=2)
         h_w4 = F.max(self.cnn_w4(ex_block), axis=2)
@@ -382,7 +560,7 @@ class CNNEncoder(chainer.Chain):
         return self.mlp(h, no_dropout=True), ex_block
 
     def __call__(self, xs, dknn=False, no_dropout=False):
-        x_block = chainer.dataset.convert.concat_examples(xs, padding=-1)
+        x_block = pad_sequences(xs)
         dropout = 0. if no_dropout else self.dropout
         ex_block = block_embed(self.embed, x_block, dropout)
         h_w3 = F.max(self.cnn_w3(ex_block), axis=2)
@@ -451,16 +629,16 @@ class BOWEncoder(chainer.Chain):
         self.n_dknn_layers = 1
 
     def get_grad(self, xs):
-        x_block = chainer.dataset.convert.concat_examples(xs, padding=-1)
+        x_block = pad_sequences(xs)
         ex_block = block_embed(self.embed, x_block)
-        x_len = self.xp.array([len(x) for x in xs], np.int32)[:, None, None]
+        x_len = sequence_lengths(self.xp, xs)
         h = F.sum(ex_block, axis=2) / x_len
         return h, ex_block
 
     def __call__(self, xs, dknn=False, no_dropout=False):
-        x_block = chainer.dataset.convert.concat_examples(xs, padding=-1)
+        x_block = pad_sequences(xs)
         ex_block = block_embed(self.embed, x_block)
-        x_len = self.xp.array([len(x) for x in xs], np.int32)[:, None, None]
+        x_len = sequence_lengths(self.xp, xs)
         h = F.sum(ex_block, axis=2) / x_len
         if dknn:
             return h, [F.squeeze(h, 2)]
@@ -1,5 +1,11 @@
 import io
+import os
+import json
+import hashlib
+import itertools
 import collections
+import threading
+import multiprocessing
 import numpy
 
 import chainer
@@ -16,12 +22,7 @@ def normalize_text(text):
     return text.strip().lower()
 
 
-def make_vocab(dataset, max_vocab_size=200000, min_freq=2):
-    counts = collections.defaultdict(int)
-    for tokens, _ in dataset:
-        for token in tokens:
-            counts[token] += 1
-
+def vocab_from_counts(counts, max_vocab_size=200000, min_freq=2):
     special = ['<eos>', '<unk>']
     vocab = {x: i for i, x in enumerate(special)}
     for w, c in sorted(counts.items(), key=lambda x: (-x[1], x[0])):
@@ -31,6 +32,172 @@ def make_vocab(dataset, max_vocab_size=200000, min_freq=2):
     return vocab
 
 
+def make_vocab(dataset, max_vocab_size=200000, min_freq=2):
+    counts = collections.Counter()
+    for tokens, _ in dataset:
+        counts.update(tokens)
+    return vocab_from_counts(counts, max_vocab_size, min_freq)
+
+
+'''streaming corpus preparation. a corpus is an iterable of raw records
+(texts, label), where texts is a tuple of strings (one for text
+classification, premise and hypothesis for snli). records are cut into
+chunks that are tokenized in a pool of worker processes: count_tokens
+merges the partial Counters of the workers and encode_records maps the
+tokens to ids in the workers, so only ids come back to the main process'''
+
+# vocabulary and tokenization mode of a worker, set by _init_worker
+_worker_vocab = None
+_worker_char_based = False
+
+
+def _init_worker(vocab, char_based):
+    global _worker_vocab, _worker_char_based
+    _worker_vocab = vocab
+    _worker_char_based = char_based
+
+
+def _count_chunk(records):
+    counts = collections.Counter()
+    for texts, _ in records:
+        for text in texts:
+            counts.update(split_text(normalize_text(text), _worker_char_based))
+    return counts
+
+
+def _encode_chunk(records):
+    examples = []
+    for texts, label in records:
+        ids = tuple(make_array(split_text(normalize_text(text),
+                                          _worker_char_based),
+                               _worker_vocab)
+                    for text in texts)
+        examples.append(ids + (numpy.array([label], numpy.int32),))
+    return examples
+
+
+def _chunks(iterable, chunk_size):
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _map_chunks(func, records, vocab, char_based, n_workers, chunk_size):
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    chunks = _chunks(records, chunk_size)
+    if n_workers <= 1:
+        _init_worker(vocab, char_based)
+        for chunk in chunks:
+            yield func(chunk)
+        return
+
+    # at most a few chunks per worker are read ahead of the results
+    # consumed, so reading the corpus never runs far ahead of the workers.
+    # the chunks go through a single imap, so no worker waits for the
+    # others between chunks. the chunks are read by the task handler thread
+    # of the pool, which has to stop waiting for a slot once no more
+    # results are consumed (an error in a worker, or the caller stopped),
+    # else terminate waits for it forever
+    read_ahead = threading.BoundedSemaphore(2 * n_workers)
+    stop = threading.Event()
+
+    def bounded(chunks):
+        for chunk in chunks:
+            while not read_ahead.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            yield chunk
+
+    pool = multiprocessing.Pool(n_workers, _init_worker, (vocab, char_based))
+    try:
+        for result in pool.imap(func, bounded(chunks), chunksize=1):
+            read_ahead.release()
+            yield result
+    finally:
+        stop.set()
+        pool.terminate()
+        pool.join()
+
+
+def count_tokens(records, char_based=False, n_workers=None,
+                 chunk_size=2000):
+    counts = collections.Counter()
+    for partial in _map_chunks(_count_chunk, records, None, char_based,
+                               n_workers, chunk_size):
+        counts.update(partial)
+    return counts
+
+
+def encode_records(records, vocab, char_based=False, n_workers=None,
+                   chunk_size=2000):
+    dataset = []
+    for examples in _map_chunks(_encode_chunk, records, vocab, char_based,
+                                n_workers, chunk_size):
+        dataset.extend(examples)
+    return dataset
+
+
+def vocab_words(vocab):
+    '''returns the words of vocab as an object array indexed by their id,
+    to decode token ids in bulk. a fixed width str array would take the
+    width of the longest word (e.g. a url) for every word'''
+    words = numpy.empty(len(vocab), dtype=object)
+    for w, i in vocab.items():
+        words[i] = w
+    return words
+
+
+def save_words(path, words):
+    '''saves the words of vocab_words in the directory path, as one UTF-8
+    buffer and the offset of each word in it'''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    encoded = [w.encode('utf-8') for w in words]
+    offsets = numpy.zeros(len(encoded) + 1, numpy.int64)
+    numpy.cumsum([len(w) for w in encoded], out=offsets[1:])
+    with open(os.path.join(path, 'words.bin'), 'wb') as f:
+        f.write(b''.join(encoded))
+    numpy.save(os.path.join(path, 'offsets.npy'), offsets)
+
+
+class WordTable(object):
+
+    """Words saved by :func:`save_words`, memory mapped.
+
+    Indexing with an array of token ids returns an object array of their
+    words, like the array of :func:`vocab_words`, but only the words that
+    are looked up are decoded.
+
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        self.offsets = numpy.load(os.path.join(path, 'offsets.npy'),
+                                  mmap_mode=mmap_mode)
+        filename = os.path.join(path, 'words.bin')
+        if mmap_mode is None or self.offsets[-1] == 0:
+            self.buffer = numpy.fromfile(filename, numpy.uint8)
+        else:
+            self.buffer = numpy.memmap(filename, numpy.uint8, mmap_mode)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, ids):
+        ids = numpy.asarray(ids, numpy.int64)
+        unique, inverse = numpy.unique(ids, return_inverse=True)
+        words = numpy.empty(len(unique), dtype=object)
+        for j, i in enumerate(unique):
+            words[j] = self.buffer[self.offsets[i]:self.offsets[i + 1]] \
+                .tobytes().decode('utf-8')
+        return words[inverse.reshape(ids.shape)]
+
+
 def read_vocab_list(path, max_vocab_size=200000):
     vocab = {'<eos>': 0, '<unk>': 1}
     with io.open(path, encoding='utf-8', errors='ignore') as f:
@@ -43,6 +210,67 @@ def read_vocab_list(path, max_vocab_size=200000):
     return vocab
 
 
+def load_word_vectors(path, vocab, cache=True):
+    '''reads pretrained word vectors stored as text, one "word v_1 ... v_d"
+    line per word (GloVe, fastText .vec, ...), for the words in vocab.
+    lines of words outside the vocabulary are skipped before their numbers
+    are parsed. returns the vocab ids that were found and a (n_found, d)
+    float32 matrix with their vectors.
+
+    with cache, the result is also written next to path as
+    <path>.<digest>.npy plus a .json list of the words of each row, and
+    later calls read it from there. the digest covers the vocabulary and
+    the path, size and modification time of the vectors file, so a changed
+    file is read again. the cache is skipped if it cannot be written'''
+    st = os.stat(path)
+    key = '{}\n{}\n{}\n'.format(os.path.realpath(path), st.st_size,
+                                 st.st_mtime)
+    digest = hashlib.md5((key + '\n'.join(sorted(vocab))).encode('utf-8'))
+    prefix = '{}.{}'.format(path, digest.hexdigest()[:12])
+    if cache and os.path.exists(prefix + '.npy'):
+        with io.open(prefix + '.json', encoding='utf-8') as f:
+            words = json.load(f)
+        ids = numpy.array([vocab[w] for w in words], numpy.int32)
+        return ids, numpy.load(prefix + '.npy')
+
+    found = {}
+    with io.open(path, 'rb') as f:
+        first = f.readline()
+        fields = first.split()
+        if len(fields) == 2:  # fastText header: "n_words n_dim"
+            n_dim = int(fields[1])
+            lines = f
+        else:
+            n_dim = len(fields) - 1
+            lines = itertools.chain([first], f)
+        for line in lines:
+            word, _, rest = line.rstrip().partition(b' ')
+            word = word.decode('utf-8', 'ignore')
+            if word not in vocab:
+                continue
+            try:
+                vec = numpy.fromstring(rest, numpy.float32, sep=' ')
+            except ValueError:  # words containing spaces
+                continue
+            if len(vec) == n_dim:
+                found[word] = vec
+
+    words = sorted(found, key=vocab.get)
+    ids = numpy.array([vocab[w] for w in words], numpy.int32)
+    vectors = numpy.empty((len(words), n_dim), numpy.float32)
+    for i, w in enumerate(words):
+        vectors[i] = found[w]
+    if cache:
+        # the .npy is written last: the cache is only used once it exists
+        try:
+            with io.open(prefix + '.json', 'w', encoding='utf-8') as f:
+                f.write(json.dumps(words, ensure_ascii=False))
+            numpy.save(prefix + '.npy', vectors)
+        except (IOError, OSError):  # e.g. a read only directory
+            pass
+    return ids, vectors
+
+
 def make_array(tokens, vocab, add_eos=True):
     unk_id = vocab['<unk>']
     eos_id = vocab['<eos>']
@@ -52,6 +280,88 @@ def make_array(tokens, vocab, add_eos=True):
     return numpy.array(ids, numpy.int32)
 
 
+class VocabEncoder(object):
+
+    """Maps batches of raw texts to ragged token id batches.
+
+    Texts are normalized and split like :func:`normalize_text` and
+    :func:`split_text`, so the ids are the same as those of
+    :func:`make_array`, but a whole batch is encoded into one flat array
+    instead of one array per text. Words are looked up by mapping a dict
+    that returns the ``<unk>`` id for missing words over all tokens of the
+    batch, without a Python call per token. Characters are looked up in a
+    table indexed by code point, over the UTF-32 code points of the whole
+    batch at once.
+
+    Args:
+        vocab (dict): Maps words (or characters) to ids.
+        char_based (bool): If ``True``, texts are split into characters.
+
+    """
+
+    def __init__(self, vocab, char_based=False):
+        self.unk_id = vocab['<unk>']
+        self.eos_id = vocab['<eos>']
+        self.char_based = char_based
+        if char_based:
+            chars = {ord(c): i for c, i in vocab.items() if len(c) == 1}
+            self.table = numpy.full(max(chars, default=0) + 1, self.unk_id,
+                                    numpy.int32)
+            self.table[list(chars)] = list(chars.values())
+        else:
+            self.table = _UnkDict(vocab)
+
+    def _lookup_chars(self, text):
+        codes = numpy.frombuffer(text.encode('utf-32-le'), numpy.uint32)
+        known = codes < len(self.table)
+        return numpy.where(known, self.table[numpy.where(known, codes, 0)],
+                           self.unk_id).astype(numpy.int32)
+
+    def encode(self, texts, add_eos=True):
+        """Encodes a batch of raw texts.
+
+        Returns:
+            tuple: The concatenated int32 ids of the texts and the
+            :math:`(N + 1, )`-shaped start offsets of the texts, like
+            :class:`RaggedDataset`.
+
+        """
+        texts = [normalize_text(t) for t in texts]
+        if self.char_based:
+            ids = self._lookup_chars(''.join(texts))
+            lengths = numpy.array([len(t) for t in texts], numpy.int64)
+        else:
+            split = [t.split() for t in texts]
+            lengths = numpy.array([len(x) for x in split], numpy.int64)
+            ids = numpy.fromiter(
+                map(self.table.__getitem__,
+                    itertools.chain.from_iterable(split)),
+                numpy.int32, count=int(lengths.sum()))
+        if add_eos:
+            lengths += 1
+        offsets = numpy.zeros(len(texts) + 1, numpy.int64)
+        numpy.cumsum(lengths, out=offsets[1:])
+        if not add_eos:
+            return ids, offsets
+        tokens = numpy.empty(offsets[-1], numpy.int32)
+        is_eos = numpy.zeros(len(tokens), bool)
+        is_eos[offsets[1:] - 1] = True
+        tokens[is_eos] = self.eos_id
+        tokens[~is_eos] = ids
+        return tokens, offsets
+
+
+class _UnkDict(dict):
+    # vocabulary that returns the <unk> id for missing words
+
+    def __init__(self, vocab):
+        super(_UnkDict, self).__init__(vocab)
+        self.unk_id = vocab['<unk>']
+
+    def __missing__(self, key):
+        return self.unk_id
+
+
 def transform_to_array(dataset, vocab, with_label=True):
     if with_label:
         return [(make_array(tokens, vocab), numpy.array([cls], numpy.int32))
@@ -83,6 +393,231 @@ def convert_seq(batch, device=None, with_label=True):
         return to_device_batch([x for x in batch])
 
 
+class RaggedDataset(chainer.dataset.DatasetMixin):
+
+    """A text classification dataset kept as one flat token array.
+
+    Instead of one small array per example, all token ids are stored
+    back to back in ``tokens`` and example ``i`` spans
+    ``tokens[offsets[i]:offsets[i + 1]]``. Examples are returned as views
+    into the flat store, in the same ``(tokens, label)`` form as
+    :func:`transform_to_array`.
+
+    The arrays can be saved as ``.npy`` files and memory mapped back
+    (:meth:`save`, :meth:`load`), so the texts of a large dataset can be
+    looked up and decoded (:meth:`decode`) without reading it into RAM.
+
+    Args:
+        tokens (numpy.ndarray): Concatenated int32 token ids.
+        offsets (numpy.ndarray): :math:`(N + 1, )`-shaped start offsets.
+        labels (numpy.ndarray): :math:`(N, )`-shaped int32 labels.
+
+    """
+
+    def __init__(self, tokens, offsets, labels):
+        assert len(offsets) == len(labels) + 1
+        self.tokens = tokens
+        self.offsets = offsets
+        self.labels = labels
+
+    @classmethod
+    def from_examples(cls, dataset):
+        lengths = numpy.array([len(x) for x, _ in dataset], numpy.int64)
+        offsets = numpy.zeros(len(dataset) + 1, numpy.int64)
+        numpy.cumsum(lengths, out=offsets[1:])
+        tokens = numpy.empty(offsets[-1], numpy.int32)
+        labels = numpy.empty(len(dataset), numpy.int32)
+        for i, (x, y) in enumerate(dataset):
+            tokens[offsets[i]:offsets[i + 1]] = x
+            labels[i] = int(y[0]) if numpy.ndim(y) else int(y)
+        return cls(tokens, offsets, labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def get_example(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.tokens[start:end], self.labels[i:i + 1]
+
+    def save(self, path):
+        '''saves the dataset as .npy files in the directory path'''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in ('tokens', 'offsets', 'labels'):
+            numpy.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''loads a dataset saved by save, memory mapped by default'''
+        return cls(*[numpy.load(os.path.join(path, name + '.npy'),
+                                mmap_mode=mmap_mode)
+                     for name in ('tokens', 'offsets', 'labels')])
+
+    def decode(self, indices, words, char_based=False):
+        '''returns the texts of the examples at indices. words[i] is the
+        word (or character) of token id i, see vocab_words. the tokens of
+        all examples are gathered and looked up at once'''
+        indices = numpy.asarray(indices, numpy.int64)
+        if len(indices) == 0:
+            return []
+        starts = numpy.asarray(self.offsets[indices])
+        lengths = numpy.asarray(self.offsets[indices + 1]) - starts
+        ends = numpy.cumsum(lengths)
+        positions = (numpy.arange(ends[-1]) +
+                     numpy.repeat(starts - ends + lengths, lengths))
+        decoded = words[numpy.asarray(self.tokens[positions])]
+        sep = '' if char_based else ' '
+        return [sep.join(text) for text in numpy.split(decoded, ends[:-1])]
+
+
+class SequenceBatch(object):
+
+    """A minibatch of variable-length token sequences.
+
+    The batch is kept in two layouts that live in the same device
+    allocation: ``tokens`` holds all sequences concatenated and ``block``
+    holds them padded with ``-1`` into a :math:`(B, L_{max})` array.
+    Iterating over the batch yields views of ``tokens``, so it can be
+    passed wherever a list of sequences is expected.
+
+    Args:
+        tokens: Concatenated int32 token ids of all sequences.
+        lengths (numpy.ndarray): Host array with the length of each
+            sequence.
+        block: :math:`(B, L_{max})`-shaped int32 array padded with ``-1``.
+        xp_lengths: ``lengths`` on the device of ``tokens``.
+
+    """
+
+    def __init__(self, tokens, lengths, block, xp_lengths):
+        self.tokens = tokens
+        self.lengths = lengths
+        self.block = block
+        self.xp_lengths = xp_lengths
+        self.offsets = numpy.zeros(len(lengths) + 1, numpy.int64)
+        numpy.cumsum(lengths, out=self.offsets[1:])
+
+    @property
+    def sections(self):
+        return self.offsets[1:-1]
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def concat_sequences(xs0, xs1):
+    '''joins two batches of sequences into one batch, xs0 first. two
+    SequenceBatch objects are joined on their device without splitting
+    them into single sequences'''
+    if not (isinstance(xs0, SequenceBatch) and
+            isinstance(xs1, SequenceBatch)):
+        return list(xs0) + list(xs1)
+    xp = cuda.get_array_module(xs0.tokens)
+    n0, width0 = xs0.block.shape
+    n1, width1 = xs1.block.shape
+    block = xp.full((n0 + n1, max(width0, width1)), -1, numpy.int32)
+    block[:n0, :width0] = xs0.block
+    block[n0:, :width1] = xs1.block
+    return SequenceBatch(xp.concatenate((xs0.tokens, xs1.tokens)),
+                         numpy.concatenate((xs0.lengths, xs1.lengths)),
+                         block,
+                         xp.concatenate((xs0.xp_lengths, xs1.xp_lengths)))
+
+
+class PackedSeqConverter(object):
+
+    """Converts a batch into :class:`SequenceBatch` objects.
+
+    The packed tokens, the padded block, the lengths and the labels of a
+    batch are written into one host buffer and copied to the device in a
+    single transfer. On GPU the host buffer is page-locked and reused
+    between calls (one buffer per thread).
+
+    Args:
+        snli (bool): If ``True``, examples are
+            ``(premise, hypothesis[, label])`` tuples and the sequences
+            are returned as a pair of batches, like
+            :func:`convert_snli_seq`.
+
+    """
+
+    def __init__(self, snli=False):
+        self.snli = snli
+        self._local = threading.local()
+
+    def _staging_buffer(self, size, device):
+        if device is None or device < 0:
+            return numpy.empty(size, numpy.int32)
+        pinned = getattr(self._local, 'pinned', None)
+        if pinned is None or pinned.size < size * 4:
+            pinned = cuda.cupy.cuda.alloc_pinned_memory(size * 4)
+            self._local.pinned = pinned
+        return numpy.frombuffer(pinned, numpy.int32, size)
+
+    def __call__(self, batch, device=None, with_label=True):
+        n_columns = 2 if self.snli else 1
+        if self.snli or with_label:
+            columns = [[example[i] for example in batch]
+                       for i in range(n_columns)]
+        else:
+            columns = [list(batch)]
+        n_labels = len(batch) if with_label else 0
+
+        # plan the layout of the staging buffer
+        layouts = []
+        size = 0
+        for seqs in columns:
+            lengths = numpy.array([len(x) for x in seqs], numpy.int32)
+            n_tokens = int(lengths.sum())
+            width = int(lengths.max())
+            layouts.append((size, lengths, n_tokens, width))
+            size += n_tokens + len(seqs) * width + len(seqs)
+
+        host = self._staging_buffer(size + n_labels, device)
+        for seqs, (start, lengths, n_tokens, width) in zip(columns, layouts):
+            tokens = host[start:start + n_tokens]
+            numpy.concatenate(seqs, out=tokens)
+            start += n_tokens
+            block = host[start:start + len(seqs) * width]
+            block = block.reshape(len(seqs), width)
+            block.fill(-1)
+            block[numpy.arange(width) < lengths[:, None]] = tokens
+            start += block.size
+            host[start:start + len(seqs)] = lengths
+        if with_label:
+            host[size:] = numpy.asarray(
+                [example[-1] for example in batch], numpy.int32).reshape(-1)
+
+        if device is None or device < 0:
+            buf = host
+        else:
+            buf = cuda.to_gpu(host, device=device)
+
+        xs = []
+        for start, lengths, n_tokens, width in layouts:
+            n = len(lengths)
+            block_start = start + n_tokens
+            lengths_start = block_start + n * width
+            xs.append(SequenceBatch(
+                buf[start:block_start], lengths,
+                buf[block_start:lengths_start].reshape(n, width),
+                buf[lengths_start:lengths_start + n]))
+        xs = tuple(xs) if self.snli else xs[0]
+
+        if with_label:
+            ys = buf[size:].reshape(-1, 1)
+            return {'xs': xs, 'ys': [y for y in ys]}
+        else:
+            return xs
+
+
 def transform_snli_to_array(dataset, vocab, with_label=True):
     if with_label:        
         return [(make_array(premise, vocab),
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import argparse
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from chainer.backends import cuda
+
+from nets import inference_mode
+from nlp_utils import PackedSeqConverter, VocabEncoder, vocab_words
+from run_dknn import DkNN
+from utils import load_model
+
+'''serves several trained models, e.g. the cnn, bilstm and bow models of a
+dataset, from one process. models are registered by name and can be
+replaced, or given a new dknn index, while requests are running'''
+
+# a vocabulary shared by all of the models trained with it
+Vocabulary = namedtuple('Vocabulary', ['vocab', 'encoder', 'words'])
+
+# what a request runs with: a registered model, its vocabulary and its
+# optional dknn index. entries are never changed, a swap registers a new one
+Entry = namedtuple('Entry', ['name', 'setup', 'model', 'vocabulary', 'dknn',
+                             'version'])
+
+
+class ModelRegistry(object):
+
+    """Models and DkNN indexes of several stored results in one process.
+
+    A model is loaded from the ``args.json`` of its result with
+    :meth:`load`, optionally with an index saved by :meth:`DkNN.save`.
+    Vocabularies are read once per file and shared by all of the models
+    trained with them, and indexes are loaded with ``mmap_mode``, so brute
+    force indexes and training texts are memory mapped, read only, and
+    their pages are shared by the models, by successive versions of an
+    index and by other processes that map the same files.
+
+    A request takes the current :class:`Entry` of a model once with
+    :meth:`get` and uses only that entry. :meth:`load` and
+    :meth:`swap_index` build the new model or index before they replace the
+    entry under a lock, so running requests finish with the entry they
+    started with and new requests get the new one. The old model and index
+    are freed when the last request using them ends. A new index has to be
+    saved to a new directory: the files of a mapped index must not be
+    overwritten.
+
+    Args:
+        gpu (int): GPU the models are copied to (negative for the CPU).
+        mmap_mode (str): ``mmap_mode`` of :meth:`DkNN.load`.
+        dtype: If given, e.g. ``numpy.float16``, the parameters of the
+            models are cast to it (see :func:`nets.cast_params`).
+
+    """
+
+    def __init__(self, gpu=-1, mmap_mode='r', dtype=None):
+        self.gpu = gpu
+        self.mmap_mode = mmap_mode
+        self.dtype = dtype
+        self._entries = {}
+        self._vocabularies = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def names(self):
+        return sorted(self._entries)
+
+    def get(self, name):
+        '''the current entry of the model name'''
+        try:
+            return self._entries[name]
+        except KeyError:
+            raise KeyError('no model named {}'.format(name))
+
+    def _vocabulary(self, path):
+        path = os.path.realpath(path)
+        with self._lock:
+            vocabulary = self._vocabularies.get(path)
+        if vocabulary is not None:
+            return vocabulary
+        with open(path) as f:
+            vocab = json.load(f)
+        # char_based only changes the encoder, which is made on demand
+        vocabulary = Vocabulary(vocab, {}, vocab_words(vocab))
+        with self._lock:
+            return self._vocabularies.setdefault(path, vocabulary)
+
+    def _encoder(self, vocabulary, char_based):
+        encoder = vocabulary.encoder.get(char_based)
+        if encoder is None:
+            encoder = vocabulary.encoder.setdefault(
+                char_based, VocabEncoder(vocabulary.vocab, char_based))
+        return encoder
+
+    def _load_index(self, model, path, vocabulary):
+        dknn = DkNN.load(model, path, mmap_mode=self.mmap_mode)
+        if dknn.words is not None:
+            # the index was built with the vocabulary of its model
+            dknn.words = vocabulary.words
+        return dknn
+
+    def _replace(self, name, make_entry):
+        with self._lock:
+            old = self._entries.get(name)
+            entry = make_entry(old)
+            self._entries[name] = entry._replace(
+                version=0 if old is None else old.version + 1)
+            return self._entries[name]
+
+    def load(self, name, model_setup, index=None):
+        '''loads (or reloads) the model of the result model_setup (its
+        args.json) as name, with the dknn index saved in the directory
+        index if one is given. returns the new entry'''
+        with open(model_setup) as f:
+            setup = json.load(f)
+        vocabulary = self._vocabulary(setup['vocab_path'])
+        model = load_model(setup, len(vocabulary.vocab), self.gpu,
+                           self.dtype)
+        dknn = None
+        if index is not None:
+            dknn = self._load_index(model, index, vocabulary)
+        entry = Entry(name, setup, model, vocabulary, dknn, None)
+        return self._replace(name, lambda old: entry)
+
+    def swap_index(self, name, index):
+        '''replaces the dknn index of the model name by the one saved in
+        the directory index. returns the new entry'''
+        entry = self.get(name)
+        dknn = self._load_index(entry.model, index, entry.vocabulary)
+
+        def make_entry(old):
+            if old is None or old.model is not entry.model:
+                raise RuntimeError(
+                    'model {} was replaced while its index was loaded'.format(
+                        name))
+            return old._replace(dknn=dknn)
+        return self._replace(name, make_entry)
+
+    def remove(self, name):
+        with self._lock:
+            del self._entries[name]
+
+    def predict(self, name, sentences, calibrated=True):
+        '''classifies raw sentences with the model name. returns the
+        predictions and the probabilities of the model and, if it has an
+        index, the dknn predictions, credibility and confidence'''
+        entry = self.get(name)
+        setup = entry.setup
+        if setup['dataset'] == 'snli':
+            raise ValueError('scoring single sentences is not supported for '
+                             'snli')
+        encoder = self._encoder(entry.vocabulary, setup['char_based'])
+        tokens, offsets = encoder.encode(sentences)
+        xs = np.split(tokens, offsets[1:-1])
+        xs = PackedSeqConverter()(xs, device=self.gpu, with_label=False)
+
+        result = {}
+        with inference_mode(self.dtype):
+            if entry.dknn is None:
+                probs = cuda.to_cpu(entry.model.predict(xs, softmax=True))
+                result['pred'] = probs.argmax(axis=1).tolist()
+                result['conf'] = probs.max(axis=1).tolist()
+                return result
+            knn_pred, knn_cred, knn_conf, reg_pred, reg_conf = \
+                entry.dknn.predict(xs, calibrated=calibrated)
+        result.update({'pred': reg_pred, 'conf': reg_conf,
+                       'knn_pred': knn_pred, 'knn_cred': knn_cred,
+                       'knn_conf': knn_conf})
+        return result
+
+
+def handle_line(registry, line):
+    '''runs one line of the protocol of main: a "!load" or "!index"
+    command, or a "name<TAB>sentence" request'''
+    if line.startswith('!'):
+        command = line[1:].split()
+        if command[:1] == ['load'] and len(command) in (3, 4):
+            entry = registry.load(*command[1:])
+        elif command[:1] == ['index'] and len(command) == 3:
+            entry = registry.swap_index(*command[1:])
+        else:
+            raise ValueError('unknown command')
+        sys.stderr.write('# {} version {}\n'.format(entry.name,
+                                                    entry.version))
+        return
+    if '\t' not in line:
+        raise ValueError('expected "name<TAB>sentence"')
+    name, sentence = line.split('\t', 1)
+    result = registry.predict(name, [sentence])
+    # prediction and probability, then those of dknn if there is an
+    # index, tab separated
+    columns = [result['pred'][0], '{:.4f}'.format(result['conf'][0])]
+    if 'knn_pred' in result:
+        columns += [result['knn_pred'][0],
+                    '{:.4f}'.format(result['knn_cred'][0])]
+    print('\t'.join([name] + [str(c) for c in columns] + [sentence]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Classify lines "name<TAB>sentence" read from stdin with \
+                     the model registered as name. A line "!load name \
+                     args.json [index]" loads or replaces a model, "!index \
+                     name index" swaps its dknn index.')
+    parser.add_argument('--gpu', '-g', type=int, default=-1,
+                        help='GPU ID (negative value indicates CPU)')
+    parser.add_argument('--dtype', choices=('float32', 'float16'),
+                        default=None,
+                        help='Cast the parameters of the models to this \
+                              dtype (float16 is meant for GPUs).')
+    parser.add_argument('--model', nargs='+', action='append', default=[],
+                        metavar=('NAME SETUP', 'INDEX'),
+                        help='Name and model setup dictionary of a model, \
+                              and optionally the directory of its saved \
+                              dknn index. Can be repeated.')
+    args = parser.parse_args(argv)
+
+    registry = ModelRegistry(gpu=args.gpu, dtype=args.dtype)
+    for model in args.model:
+        if len(model) not in (2, 3):
+            parser.error('--model takes a name, a setup and an index')
+        registry.load(*model)
+
+    for line in sys.stdin:
+        # a bad line (unknown model, missing file, no tab) is reported
+        # and skipped, the other requests go on
+        try:
+            handle_line(registry, line.rstrip('\n'))
+        except Exception as e:
+            sys.stderr.write('error in line {!r}: {}: {}\n'.format(
+                line.rstrip('\n'), type(e).__name__, e))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
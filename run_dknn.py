@@ -1,69 +1,243 @@
 #!/usr/bin/env python
 import os
 import json
+import atexit
+import pickle
+import shutil
 import argparse
+import tempfile
 from tqdm import tqdm
 from collections import Counter
 import numpy as np
-import cupy as cp
 
-import chainer
 import chainer.functions as F
+from chainer.backends import cuda
 
-from nearpy import Engine
-from nearpy.hashes import RandomBinaryProjectionTree
-from sklearn.neighbors import KDTree
-
-from nlp_utils import convert_seq, convert_snli_seq
-from utils import setup_model
+from iterators import BucketIterator, PrefetchIterator
+from knn_index import (STORAGES, REDUCTIONS, BruteForceIndex, IVFIndex,
+                       LinearProjection, l2_normalize, make_reduction)
+from metrics import EvaluationReport
+from nlp_utils import (convert_seq, PackedSeqConverter, RaggedDataset,
+                       SequenceBatch, WordTable, save_words, vocab_words)
+from utils import setup_model, split_calibration
 
 '''contains all of the code to run Deep K Nearest Neighbors
 for any model'''
 
+
+def flatten_rows(rows):
+    '''flattens the neighbors (or neighbor labels) of a batch, a (B, k)
+    array or a list of arrays of any lengths (lsh). returns the flat
+    values, the row of each value and the length of each row'''
+    if isinstance(rows, np.ndarray):
+        n, k = rows.shape
+        lengths = np.full(n, k, np.int64)
+        flat = rows.ravel()
+    else:
+        lengths = np.array([len(x) for x in rows], np.int64)
+        flat = np.concatenate([np.asarray(x, np.int64).ravel()
+                               for x in rows] + [np.empty(0, np.int64)])
+    return flat, np.repeat(np.arange(len(lengths)), lengths), lengths
+
+
+def vote(knn_labels, n_class):
+    '''counts the neighbor labels of each example. knn_labels is a (B, k)
+    array, or a list of label arrays of any lengths (lsh). returns the
+    (B, n_class) counts, and the position of the first neighbor with each
+    label (the largest number of neighbors if there is none)'''
+    flat, rows, lengths = flatten_rows(knn_labels)
+    n = len(lengths)
+    starts = np.cumsum(lengths) - lengths
+    positions = np.arange(len(flat)) - np.repeat(starts, lengths)
+    cells = rows * n_class + flat
+    counts = np.bincount(cells, minlength=n * n_class).reshape(n, n_class)
+    first = np.full(n * n_class, lengths.max() if n else 0, np.int64)
+    cells, first_idx = np.unique(cells, return_index=True)
+    first[cells] = positions[first_idx]
+    return counts, first.reshape(n, n_class)
+
+
+def batch_lengths(xs, snli=False):
+    '''lengths of the sequences of a converted batch, of the hypotheses
+    for snli'''
+    if snli:
+        xs = xs[1]
+    if isinstance(xs, SequenceBatch):
+        return xs.lengths
+    return [len(x) for x in xs]
+
+
+def neighbor_overlap(neighbors, variant_neighbors, owners):
+    '''for each row i of variant_neighbors, the fraction of its neighbors
+    that are also neighbors in row owners[i] of neighbors. both are (B, k)
+    arrays or lists of index arrays (lsh). all rows are intersected at once
+    by a single sorted membership test on (row, neighbor) keys'''
+    flat, rows, _ = flatten_rows(neighbors)
+    v_flat, v_rows, v_lengths = flatten_rows(variant_neighbors)
+    owners = np.asarray(owners, np.int64)
+    width = int(max(flat.max(initial=0), v_flat.max(initial=0))) + 1
+    shared = np.isin(owners[v_rows] * width + v_flat, rows * width + flat)
+    return (np.bincount(v_rows, shared, minlength=len(v_lengths)) /
+            np.maximum(v_lengths, 1))
+
+
 class DkNN:
 
-    def __init__(self, model, lsh=False):
+    def __init__(self, model, lsh=False, layer_ids=None, algorithm=None,
+                 storage='float32', reduction=None, n_components=64,
+                 metric='euclidean', early_k=45, n_lists=None, n_probe=16,
+                 work_dir=None):
         self.model = model
         self.n_dknn_layers = self.model.n_dknn_layers
+        # 'kd_tree', 'lsh', 'brute' or 'ivf'. the exact brute force search
+        # supports activations stored as float16 or int8, the inverted
+        # file index as float16
+        if algorithm is None:
+            algorithm = 'lsh' if lsh else 'kd_tree'
+        if storage != 'float32' and algorithm not in ('brute', 'ivf') or \
+                storage == 'int8' and algorithm == 'ivf':
+            raise ValueError('{} storage is not supported by {}'.format(
+                storage, algorithm))
+        self.algorithm = algorithm
+        self.storage = storage
+        # the inverted file index ('ivf') is built out of core: the
+        # activations are written to files in work_dir (a new temporary
+        # directory by default, removed at exit) and the index is built
+        # there from them
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.work_dir = work_dir
+        self._owns_work_dir = False
+        self._activation_files = []  # written by the current build
+        lsh = algorithm == 'lsh'
+        # the layers that are indexed. lsh takes the neighbors of all of
+        # them, the kdtree only those of the last one
+        if layer_ids is None:
+            if lsh:
+                layer_ids = list(range(self.n_dknn_layers))
+            else:
+                layer_ids = [self.n_dknn_layers - 1]
+        self.layer_ids = [i % self.n_dknn_layers for i in layer_ids]
+        # optional projection of each indexed layer to n_components
+        # dimensions ('pca', 'gaussian' or 'sparse'), fitted by build
+        if reduction is not None and reduction not in REDUCTIONS:
+            raise ValueError('unknown reduction {}'.format(reduction))
+        self.reduction = reduction
+        self.n_components = n_components
+        self.reductions = [None] * len(self.layer_ids)
+        # with 'cosine', activations are L2-normalized once when they are
+        # indexed and queried, and the brute force search is a maximum
+        # inner product search
+        if metric not in ('euclidean', 'cosine'):
+            raise ValueError('unknown metric {}'.format(metric))
+        self.metric = metric
+        self.act_list = None
+        # optional training texts (see set_text_store), one RaggedDataset
+        # per sequence of the examples, and the words of the vocabulary
+        self.text_stores = None
+        self.words = None
+        self.char_based = False
         self.tree_list = None
         self.label_list = None
-        self._A = None
+        self.n_class = None
+        self._A = None  # sorted calibration scores
         self.lsh = lsh
+        # neighbors voted on first by the early exit mode of the exact
+        # search, and the neighbors (or lsh layers) it searched and skipped.
+        # a vote can only be decided by more than half of the 75 neighbors
+        if not 37 < early_k <= 75:
+            raise ValueError('early_k must be between 38 and 75')
+        self.early_k = early_k
+        self.search_stats = Counter()
+
+    '''an array for the activations of all of the training data, memory
+    mapped from the file name in work_dir for the out of core ivf build.
+    the files are removed once the index is built'''
+    def _activation_array(self, name, shape, dtype):
+        if self.algorithm != 'ivf':
+            return np.empty(shape, dtype)
+        if self.work_dir is None:
+            # the index is only kept if it is saved (copied) elsewhere
+            self.work_dir = tempfile.mkdtemp(prefix='dknn')
+            self._owns_work_dir = True
+            atexit.register(shutil.rmtree, self.work_dir, True)
+        elif not os.path.isdir(self.work_dir):
+            os.makedirs(self.work_dir)
+        filename = os.path.join(self.work_dir, name + '.npy')
+        self._activation_files.append(filename)
+        return np.lib.format.open_memmap(filename, 'w+', dtype, shape)
 
     '''builds the nearest neighbor lookup data structures for all of the training
     data'''
-    def build(self, train, batch_size=64, converter=convert_seq, device=0):
-        train_iter = chainer.iterators.SerialIterator(
-                train, batch_size, repeat=False)
-        train_iter.reset()
-
-        act_list = [[] for _ in range(self.n_dknn_layers)]
-        label_list = []
+    def build(self, train, batch_size=64, converter=convert_seq, device=0,
+              prefetch=2):
+        # batches of similar length, written back in dataset order
+        train_iter = BucketIterator(
+                train, batch_size, repeat=False, shuffle=False)
+        n_batches = train_iter.n_batches
+        train_iter = PrefetchIterator(train_iter, converter, device,
+                                      n_prefetch=prefetch)
+
+        act_list = [None] * len(self.layer_ids)
+        label_list = np.empty(len(train), np.int32)
+        self._activation_files = []
         print('caching hiddens')
-        n_batches = len(train) // batch_size
-        for i, train_batch in enumerate(tqdm(train_iter, total=n_batches)):
-            data = converter(train_batch, device=device, with_label=True)
+        for data in tqdm(train_iter, total=n_batches):
+            indices = train_iter.batch_indices
             text = data['xs']
             labels = data['ys']
 
-            with chainer.using_config('train', False):
-                _, dknn_layers = self.model.predict(text, dknn=True)
-                assert len(dknn_layers) == self.model.n_dknn_layers
-            for i in range(self.n_dknn_layers):
-                layer = dknn_layers[i]
-                layer.to_cpu()
-                act_list[i] += [x for x in layer.data]
-            label_list.extend([int(x) for x in labels])
+            _, dknn_layers = self.model.export_activations(
+                    text, self.layer_ids)
+            for i, layer in enumerate(dknn_layers):
+                if act_list[i] is None:
+                    act_list[i] = self._activation_array(
+                        'layer{}_act'.format(self.layer_ids[i]),
+                        (len(train), layer.shape[1]), layer.dtype)
+                act_list[i][indices] = layer
+            label_list[indices] = [int(x) for x in labels]
+        train_iter.finalize()
+
+        self.reductions = [None] * len(self.layer_ids)
+        if self.reduction is not None:
+            for i, layer_id in enumerate(self.layer_ids):
+                projection = make_reduction(
+                        act_list[i], self.reduction, self.n_components)
+                if projection is not None:
+                    print('reducing layer {} from {} to {} dims'.format(
+                        layer_id, act_list[i].shape[1], self.n_components))
+                    act_list[i] = projection(
+                        act_list[i], out=self._activation_array(
+                            'layer{}_reduced'.format(layer_id),
+                            (len(train), self.n_components), np.float32))
+                self.reductions[i] = projection
+        if self.metric == 'cosine':
+            for act in act_list:
+                l2_normalize(act)
         self.act_list = act_list
         self.label_list = label_list
+        self.n_class = int(label_list.max()) + 1
 
         if self.lsh:
             print('using Locally Sensitive Hashing for NN Search')
+        elif self.algorithm == 'brute':
+            print('using brute force ({}) for NN Search'.format(
+                self.storage))
+        elif self.algorithm == 'ivf':
+            print('using an inverted file index ({}) in {} for NN '
+                  'Search'.format(self.storage, self.work_dir))
         else:
             print('using KDTree for NN Search')
-        self.tree_list = []  # one lookup tree for each dknn layer
-        for i in range(self.n_dknn_layers):
-            print('building tree for layer {}'.format(i))
+        # nearest neighbor libraries are only needed once an index is built
+        if self.lsh:
+            from nearpy import Engine
+            from nearpy.hashes import RandomBinaryProjectionTree
+        elif self.algorithm not in ('brute', 'ivf'):
+            from sklearn.neighbors import KDTree
+
+        self.tree_list = []  # one lookup tree for each indexed layer
+        for i, layer_id in enumerate(self.layer_ids):
+            print('building tree for layer {}'.format(layer_id))
             if self.lsh:  # if lsh
                 n_hidden = act_list[i][0].shape[0]
                 rbpt = RandomBinaryProjectionTree('rbpt', 75, 75)
@@ -74,64 +248,291 @@ class DkNN:
                     assert example.shape[0] == n_hidden
 
                     tree.store_vector(example, j)
+            elif self.algorithm == 'brute':
+                tree = BruteForceIndex(act_list[i], self.storage,
+                                       self._brute_metric)
+            elif self.algorithm == 'ivf':
+                tree = IVFIndex.build(
+                        act_list[i], os.path.join(
+                            self.work_dir, 'layer{}'.format(layer_id)),
+                        self.n_lists, self.storage, self._brute_metric,
+                        self.n_probe)
             else:  # if kdtree
                 tree = KDTree(act_list[i])
 
             self.tree_list.append(tree)
 
+        if self.algorithm == 'ivf':
+            # the indexes keep their own copy of the activations, grouped
+            # by list, so the activation files are not needed any more
+            self.act_list = act_list = None
+            for filename in self._activation_files:
+                os.remove(filename)
+            self._activation_files = []
+
+    '''keeps the texts of the indexed training data as flat token stores,
+    to return the neighbors of examples as text (get_neighbor_text).
+    train is the dataset given to build and vocab maps words to ids. a
+    RaggedDataset is used as it is'''
+    def set_text_store(self, train, vocab, char_based=False):
+        if isinstance(train, RaggedDataset):
+            self.text_stores = [train]
+        else:  # one store for each sequence, e.g. premises and hypotheses
+            n_seqs = len(train[0]) - 1
+            self.text_stores = [
+                RaggedDataset.from_examples([(x[i], x[-1]) for x in train])
+                for i in range(n_seqs)]
+        self.words = vocab_words(vocab)
+        self.char_based = char_based
+
+    '''returns the texts of the first n nearest neighbors of each example of
+    the batch xs. with several sequences per example (snli), each neighbor
+    is a tuple of texts. all neighbors of the batch are decoded at once'''
+    def get_neighbor_text(self, xs, n=5):
+        assert self.text_stores is not None
+        neighbors = [list(knn[:n]) for knn in self.get_batch_neighbors(xs)]
+        flat = [i for knn in neighbors for i in knn]
+        texts = [store.decode(flat, self.words, self.char_based)
+                 for store in self.text_stores]
+        texts = texts[0] if len(texts) == 1 else list(zip(*texts))
+        neighbor_text, start = [], 0
+        for knn in neighbors:
+            neighbor_text.append(texts[start:start + len(knn)])
+            start += len(knn)
+        return neighbor_text
+
+    '''returns the probabilities and the activations of the indexed layers
+    (or of layer_ids) of the model for xs, projected like the index'''
+    def _activations(self, xs, layer_ids=None):
+        layer_ids = self.layer_ids if layer_ids is None else layer_ids
+        reg_logits, dknn_layers = self.model.export_activations(xs, layer_ids)
+        for j, layer_id in enumerate(layer_ids):
+            projection = self.reductions[self.layer_ids.index(layer_id)]
+            if projection is not None:
+                dknn_layers[j] = projection(dknn_layers[j])
+            if self.metric == 'cosine':
+                l2_normalize(dknn_layers[j])
+        return reg_logits, dknn_layers
+
+    @property
+    def _brute_metric(self):
+        return 'inner_product' if self.metric == 'cosine' else 'euclidean'
+
+    '''saves the index (configuration, projections, lookup trees, labels,
+    calibration and training texts) in the directory path'''
+    def save(self, path):
+        assert self.tree_list is not None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        config = {'layer_ids': self.layer_ids, 'algorithm': self.algorithm,
+                  'storage': self.storage, 'reduction': self.reduction,
+                  'n_components': self.n_components, 'metric': self.metric,
+                  'n_lists': self.n_lists, 'n_probe': self.n_probe,
+                  'char_based': self.char_based}
+        with open(os.path.join(path, 'dknn.json'), 'w') as f:
+            json.dump(config, f)
+        np.save(os.path.join(path, 'labels.npy'), self.label_list)
+        if self._A is not None:
+            np.save(os.path.join(path, 'calibration.npy'), self._A)
+        if self.text_stores is not None:
+            for i, store in enumerate(self.text_stores):
+                store.save(os.path.join(path, 'text{}'.format(i)))
+            save_words(os.path.join(path, 'words'), self.words)
+        for layer_id, projection, tree in zip(
+                self.layer_ids, self.reductions, self.tree_list):
+            prefix = os.path.join(path, 'layer{}'.format(layer_id))
+            if projection is not None:
+                projection.save(prefix + '_projection.npz')
+            if self.algorithm in ('brute', 'ivf'):
+                tree.save(prefix)
+            else:
+                with open(prefix + '.pkl', 'wb') as f:
+                    pickle.dump(tree, f, pickle.HIGHEST_PROTOCOL)
+
+    '''loads an index saved by save for model. with mmap_mode='r', brute
+    force indexes are memory mapped. inverted file indexes always are'''
+    @classmethod
+    def load(cls, model, path, mmap_mode=None):
+        with open(os.path.join(path, 'dknn.json')) as f:
+            config = json.load(f)
+        char_based = config.pop('char_based', False)
+        dknn = cls(model, **config)
+        # the training texts and the words are memory mapped
+        if os.path.isdir(os.path.join(path, 'words')):
+            dknn.text_stores = []
+            while os.path.isdir(os.path.join(
+                    path, 'text{}'.format(len(dknn.text_stores)))):
+                dknn.text_stores.append(RaggedDataset.load(os.path.join(
+                    path, 'text{}'.format(len(dknn.text_stores)))))
+            dknn.words = WordTable(os.path.join(path, 'words'))
+            dknn.char_based = char_based
+        dknn.label_list = np.load(os.path.join(path, 'labels.npy'))
+        dknn.n_class = int(dknn.label_list.max()) + 1
+        calibration_path = os.path.join(path, 'calibration.npy')
+        if os.path.exists(calibration_path):
+            dknn._A = np.sort(np.load(calibration_path))
+        dknn.tree_list = []
+        for i, layer_id in enumerate(dknn.layer_ids):
+            prefix = os.path.join(path, 'layer{}'.format(layer_id))
+            if os.path.exists(prefix + '_projection.npz'):
+                dknn.reductions[i] = LinearProjection.load(
+                        prefix + '_projection.npz')
+            if dknn.algorithm == 'brute':
+                tree = BruteForceIndex.load(prefix, mmap_mode=mmap_mode)
+            elif dknn.algorithm == 'ivf':
+                tree = IVFIndex.load(prefix, mmap_mode=mmap_mode or 'r')
+            else:
+                with open(prefix + '.pkl', 'rb') as f:
+                    tree = pickle.load(f)
+            dknn.tree_list.append(tree)
+        return dknn
+
+    '''compares the dknn predictions and (uncalibrated) credibility of
+    exact search over reduced precision activations with those of float32
+    search over the same activations. needs the activations kept by build'''
+    def storage_drift(self, data, storages=('float16', 'int8'), batch_size=64,
+                      converter=convert_seq, device=0, prefetch=2):
+        assert self.act_list is not None
+        storages = ('float32', ) + tuple(s for s in storages
+                                         if s != 'float32')
+        indexes = {s: [BruteForceIndex(a, s, self._brute_metric)
+                       for a in self.act_list]
+                   for s in storages}
+
+        data_iter = BucketIterator(
+                data, batch_size, repeat=False, shuffle=False)
+        n_batches = data_iter.n_batches
+        data_iter = PrefetchIterator(data_iter, converter, device,
+                                     n_prefetch=prefetch)
+
+        print('comparing index storage')
+        stats = {s: Counter() for s in storages}
+        for batch in tqdm(data_iter, total=n_batches):
+            labels = [int(x) for x in batch['ys']]
+            _, dknn_layers = self._activations(batch['xs'])
+            reference = []
+            for storage in storages:
+                st = stats[storage]
+                knn_indices = self._knn_indices(
+                        dknn_layers, indexes[storage], lsh=False)
+                for j, neighbors in enumerate(knn_indices):
+                    neighbors = set(neighbors)
+                    label, cnt = Counter(
+                        self.label_list[list(neighbors)]).most_common(1)[0]
+                    cred = cnt / len(neighbors)
+                    st['n'] += 1
+                    st['correct'] += int(label == labels[j])
+                    if storage == 'float32':
+                        reference.append((neighbors, label, cred))
+                        continue
+                    ref_neighbors, ref_label, ref_cred = reference[j]
+                    st['agree'] += int(label == ref_label)
+                    st['overlap'] += (len(neighbors & ref_neighbors) /
+                                      len(ref_neighbors))
+                    st['drift'] += abs(cred - ref_cred)
+                    st['max_drift'] = max(st['max_drift'],
+                                          abs(cred - ref_cred))
+        data_iter.finalize()
+
+        nbytes_32 = sum(index.nbytes for index in indexes['float32'])
+        report = {}
+        for storage in storages:
+            st = stats[storage]
+            n = max(st['n'], 1)
+            nbytes = sum(index.nbytes for index in indexes[storage])
+            report[storage] = {'accuracy': st['correct'] / n,
+                               'nbytes': nbytes,
+                               'memory_ratio': nbytes / nbytes_32}
+            if storage != 'float32':
+                report[storage].update({
+                    'prediction_agreement': st['agree'] / n,
+                    'neighbor_overlap': st['overlap'] / n,
+                    'mean_credibility_drift': st['drift'] / n,
+                    'max_credibility_drift': st['max_drift']})
+        return report
+
     '''calibrates the model using a small heldout set'''
-    def calibrate(self, data, batch_size=64, converter=convert_seq, device=0):
-        data_iter = chainer.iterators.SerialIterator(
-                data, batch_size, repeat=False)
-        data_iter.reset()
+    def calibrate(self, data, batch_size=64, converter=convert_seq, device=0,
+                  prefetch=2):
+        data_iter = BucketIterator(
+                data, batch_size, repeat=False, shuffle=False)
+        n_batches = data_iter.n_batches
+        data_iter = PrefetchIterator(data_iter, converter, device,
+                                     n_prefetch=prefetch)
 
         print('calibrating credibility')
-        self._A = []
-        n_batches = len(data) // batch_size
-        for i, batch in enumerate(tqdm(data_iter, total=n_batches)):
-            batch = converter(batch, device=device, with_label=True)
-            labels = [int(x) for x in batch['ys']]
+        scores = []
+        for batch in tqdm(data_iter, total=n_batches):
+            labels = np.array([int(x) for x in batch['ys']])
             _, knn_logits = self(batch['xs'])
-            for j, _ in enumerate(batch['xs']):
-                cnt_all = len(knn_logits[j])
-                preds = dict(Counter(knn_logits[j]).most_common())
-                cnt_y = preds.get(labels[j], 0)
-                self._A.append(cnt_y / cnt_all)
+            # calibration labels can be missing from the training data
+            counts, _ = vote(knn_logits,
+                             max(self.n_class, int(labels.max()) + 1))
+            # fraction of the neighbors that have the true label
+            scores.append(counts[np.arange(len(labels)), labels] /
+                          np.maximum(counts.sum(axis=1), 1))
+        data_iter.finalize()
+        # kept sorted, so calibrated values are found by binary search
+        self._A = np.sort(np.concatenate(scores))
+
+    '''calibrated credibility of the fractions of neighbors p: the
+    fraction of the calibration scores that are at most p, i.e. of the
+    calibration examples whose nonconformity is at least that of p. the
+    more neighbors agree, the higher the credibility'''
+    def _calibrated(self, p):
+        return np.searchsorted(self._A, p, side='right') / len(self._A)
 
     '''returns what percent of the nearest neighbors are the
     same after changing the input from x to new_x'''
     def get_neighbor_change(self, new_x, x):
         full_length_neighbors = self.get_neighbors(x)
         l10_neighbors = self.get_neighbors(new_x)
-        overlap = 0.0
-        for i in l10_neighbors:
-            if i in full_length_neighbors:
-                overlap = overlap + 1
-        return overlap / len(l10_neighbors)
+        return float(neighbor_overlap(
+            [full_length_neighbors], [l10_neighbors], [0])[0])
+
+    '''returns the indices of the nearest neighbors of each example of the
+    batch xs, a (batch_size, k) array (a list of arrays with lsh)'''
+    def get_batch_neighbors(self, xs):
+        assert self.tree_list is not None
+        _, dknn_layers = self._activations(xs)
+        return self._knn_indices(dknn_layers)
+
+    '''neighbor stability of a batch of variants of the examples xs, e.g.
+    with one word left out: for each variant, the fraction of its nearest
+    neighbors shared with the example owners[i] of xs it was made from.
+    neighbors, the result of get_batch_neighbors(xs), can be given to
+    reuse the search of xs across several batches of variants'''
+    def neighbor_stability(self, xs, variants, owners, neighbors=None):
+        if neighbors is None:
+            neighbors = self.get_batch_neighbors(xs)
+        return neighbor_overlap(
+            neighbors, self.get_batch_neighbors(variants), owners)
 
     '''return the distance to the nearest neighbor on the last layer'''
     def get_nearest_distance(self, xs, layer_id=-1):
         assert self.tree_list is not None
         assert self.label_list is not None
 
-        with chainer.using_config('train', False):
-            reg_logits, dknn_layers = self.model.predict(
-                    xs, softmax=True, dknn=True)
+        layer_id = layer_id % self.n_dknn_layers
+        if layer_id not in self.layer_ids:
+            raise ValueError('layer {} is not indexed'.format(layer_id))
+        tree = self.tree_list[self.layer_ids.index(layer_id)]
+        _, (layer, ) = self._activations(xs, [layer_id])
 
-        layer = dknn_layers[layer_id]
-        layer.to_cpu()
-        layer = [x for x in layer.data]
         neighbors, distances = [], []
         for hidden in layer:
             if self.lsh:  # use lsh
-                knn = self.tree_list[layer_id].neighbours(hidden)
+                knn = tree.neighbours(hidden)
                 for nn, dis in knn:
                     neighbors.append(nn)
                     distances.append(dis)
-            else:  # use kdtree
-                dis, nn = self.tree_list[layer_id].query([hidden], k=1)
+            else:  # use kdtree or brute force
+                dis, nn = tree.query([hidden], k=1)
                 neighbors.append(nn[0][0])
                 distances.append(dis[0][0])
+        if self.metric == 'cosine' and self.algorithm == 'kd_tree':
+            # euclidean distances of unit vectors to cosine distances
+            distances = [d ** 2 / 2 for d in distances]
         return distances
 
     ''' returns the indices of the nearest neighbors according
@@ -140,67 +541,110 @@ class DkNN:
         assert self.tree_list is not None
         assert self.label_list is not None
 
-        with chainer.using_config('train', False):
-            reg_logits, dknn_layers = self.model.predict(
-                    xs, softmax=True, dknn=True)
+        reg_logits, dknn_layers = self._activations(xs)
+        return self._knn_indices(dknn_layers)[-1]
 
-        _dknn_layers = []
-        for layer in dknn_layers:
-            layer.to_cpu()
-            _dknn_layers.append([x for x in layer.data])
-        # n_examples * n_layers
-        dknn_layers = list(map(list, zip(*_dknn_layers)))
+    '''returns the neighbor indices of each example, given the exported
+    activations of the indexed layers'''
+    def _knn_indices(self, dknn_layers, tree_list=None, lsh=None):
+        tree_list = self.tree_list if tree_list is None else tree_list
+        lsh = self.lsh if lsh is None else lsh
+        if not lsh:
+            # FIXME This is the setting where you only take the last
+            # layer. the whole batch is searched at once
+            _, knn = tree_list[-1].query(dknn_layers[-1], k=75)
+            return knn
 
+        # n_examples * n_indexed_layers
+        dknn_layers = list(zip(*dknn_layers))
+
+        knn_indices = []
         for i, example_layers in enumerate(dknn_layers):
             # go through examples in the batch
             neighbors = []
             for layer_id, hidden in enumerate(example_layers):
                 # go through layers and get neighbors for each
-                if self.lsh:  # use lsh
-                    knn = self.tree_list[layer_id].neighbours(hidden)
-                    for nn in knn:
-                        neighbors.append(nn[1])
-                else:  # use kdtree
-                    _, knn = self.tree_list[layer_id].query([hidden], k=75)
-                    # FIXME This is the setting where you only take the last
-                    # layer
-                    neighbors = knn[0]
-        return neighbors
-
-    '''forward pass of model for standard inference and dknn'''
-    def __call__(self, xs):
+                knn = tree_list[layer_id].neighbours(hidden)
+                for nn in knn:
+                    neighbors.append(nn[1])
+            knn_indices.append(neighbors)
+        return knn_indices
+
+    '''neighbor labels of each example like __call__, but the search of an
+    example stops as soon as its vote is decided, i.e. the runner up label
+    could not overtake the first one even with all of the neighbors not
+    searched yet. a tree query cannot be resumed, so the exact search
+    finds all 75 neighbors in one query, as __call__ does, and only the
+    vote stops at the first early_k of them. lsh goes through the layers
+    one at a time from the last one, with at most 10 neighbors per layer
+    (the NearestFilter of nearpy), and skips the search of the others.
+    undecided examples end up with the same neighbors as __call__, so
+    predictions do not change'''
+    def _early_exit_labels(self, dknn_layers):
+        n = len(dknn_layers[0])
+        if not self.lsh:
+            _, knn = self.tree_list[-1].query(dknn_layers[-1], k=75)
+            labels = self.label_list[knn]
+            top = np.sort(vote(labels[:, :self.early_k], self.n_class)[0],
+                          axis=1)
+            lead = top[:, -1] - (top[:, -2] if self.n_class > 1 else 0)
+            decided = lead > 75 - self.early_k
+            knn_logits = [row[:self.early_k] if d else row
+                          for row, d in zip(labels, decided)]
+            self.search_stats['searched'] += n * 75
+            self.search_stats['total'] += n * 75
+            return knn_logits
+
+        n_layers = len(self.tree_list)
+        # neighbors of each example found in each layer
+        found = [[None] * n_layers for _ in range(n)]
+        active = np.arange(n)
+        for step, layer_id in enumerate(reversed(range(n_layers))):
+            for i in active:
+                knn = self.tree_list[layer_id].neighbours(
+                        dknn_layers[layer_id][i])
+                found[i][layer_id] = [nn[1] for nn in knn]
+            self.search_stats['searched'] += len(active)
+            remaining = (n_layers - step - 1) * 10
+            if remaining == 0:
+                break
+            labels = [self.label_list[np.asarray(
+                sum([f for f in found[i] if f is not None], []), np.int64)]
+                for i in active]
+            top = np.sort(vote(labels, self.n_class)[0], axis=1)
+            lead = top[:, -1] - (top[:, -2] if self.n_class > 1 else 0)
+            active = active[lead <= remaining]
+        self.search_stats['total'] += n * n_layers
+        # layers in their usual order, so ties are broken like __call__
+        return [self.label_list[np.asarray(
+                    sum([f for f in layers if f is not None], []), np.int64)]
+                for layers in found]
+
+    '''fraction of the neighbor search skipped by early exits so far'''
+    @property
+    def skipped_search(self):
+        total = self.search_stats['total']
+        if total == 0:
+            return 0.
+        return 1 - self.search_stats['searched'] / total
+
+    '''forward pass of model for standard inference and dknn. with
+    early_exit, the search of each example stops once its prediction is
+    decided (see _early_exit_labels)'''
+    def __call__(self, xs, early_exit=False):
         assert self.tree_list is not None
         assert self.label_list is not None
 
-        with chainer.using_config('train', False):
-            reg_logits, dknn_layers = self.model.predict(
-                    xs, softmax=True, dknn=True)
-
-        _dknn_layers = []
-        for layer in dknn_layers:
-            layer.to_cpu()
-            _dknn_layers.append([x for x in layer.data])
-        # n_examples * n_layers
-        dknn_layers = list(map(list, zip(*_dknn_layers)))
+        reg_logits, dknn_layers = self._activations(xs)
+        if early_exit:
+            return reg_logits, self._early_exit_labels(dknn_layers)
 
-        knn_logits = []
-        for i, example_layers in enumerate(dknn_layers):
-            # go through examples in the batch
-            neighbors = []
-            for layer_id, hidden in enumerate(example_layers):
-                # go through layers and get neighbors for each
-                if self.lsh:  # use lsh
-                    knn = self.tree_list[layer_id].neighbours(hidden)
-                    for nn in knn:
-                        neighbors.append(nn[1])
-                else:  # use kdtree
-                    _, knn = self.tree_list[layer_id].query([hidden], k=75)
-                    neighbors = knn[0]
-
-            neighbor_labels = []
-            for idx in neighbors:  # for all indices, get their label
-                neighbor_labels.append(self.label_list[idx])
-            knn_logits .append(neighbor_labels)
+        knn_indices = self._knn_indices(dknn_layers)
+        if isinstance(knn_indices, np.ndarray):  # (batch_size, k)
+            knn_logits = self.label_list[knn_indices]
+        else:  # lsh finds any number of neighbors for each example
+            knn_logits = [self.label_list[np.asarray(n, np.int64)]
+                          for n in knn_indices]
         return reg_logits, knn_logits
 
     ''' returns credibility for a certain class ys'''
@@ -209,29 +653,23 @@ class DkNN:
         assert self.label_list is not None
 
         batch_size = len(xs)
-        if use_snli:
-            batch_size = len(xs[0])
+        if use_snli:  # there can be a single premise for all hypotheses
+            batch_size = len(xs[1])
 
         _, knn_logits = self(xs)
 
-        ys = [int(y) for y in ys]
-        knn_cred = []
-
-        for i in range(batch_size):
-            cnt_all = len(knn_logits[i])
-            cnts = dict(Counter(knn_logits[i]).most_common())
-            p_1 = cnts.get(ys[i], 0) / cnt_all
-            knn_cred.append(p_1)
+        ys = np.array([int(y) for y in ys])
+        counts, _ = vote(knn_logits, max(self.n_class, int(ys.max()) + 1))
+        knn_cred = (counts[np.arange(batch_size), ys] /
+                    np.maximum(counts.sum(axis=1), 1))
         if calibrated and self._A is not None:
-            for i, p_1 in enumerate(knn_cred):
-                cnt_less = len([x for x in self._A if x < p_1])
-                knn_cred[i] = cnt_less / len(self._A)
-        return knn_cred
+            knn_cred = self._calibrated(knn_cred)
+        return knn_cred.tolist()
 
     '''returns confidence for standard prediction'''
     def get_regular_confidence(self, xs, ys=None, snli=False):
         reg_logits, knn_logits = self(xs)
-        reg_logits = cp.asnumpy(reg_logits)
+        reg_logits = cuda.to_cpu(reg_logits)
         if ys is None:
             reg_conf = np.max(reg_logits, axis=1)
         else:
@@ -242,41 +680,45 @@ class DkNN:
 
     '''predicts using normal inference and dknn. Retrieves the nearest neighbor
     hidden states, and returns the class with the highest number of nearest
-    neighbors
+    neighbors. with early_exit, the predictions are the same but the
+    credibility and confidence of the examples whose search stopped early
+    only count the neighbors found
     '''
-    def predict(self, xs, calibrated=False, snli=False):
+    def predict(self, xs, calibrated=False, snli=False, early_exit=False):
         assert self.tree_list is not None
         assert self.label_list is not None
 
         batch_size = len(xs)
-        if snli:
-            batch_size = len(xs[0])
-        reg_logits, knn_logits = self(xs)
+        if snli:  # there can be a single premise for all hypotheses
+            batch_size = len(xs[1])
+        reg_logits, knn_logits = self(xs, early_exit=early_exit)
 
         reg_pred = F.argmax(reg_logits, 1).data.tolist()
         reg_conf = F.max(reg_logits, 1).data.tolist()
 
-        knn_pred, knn_cred, knn_conf = [], [], []
-        for i in range(batch_size):
-            cnt_all = len(knn_logits[i])
-            cnts = Counter(knn_logits[i]).most_common()
-            label, cnt_1st = cnts[0]
-            if len(cnts) > 1:
-                _, cnt_2nd = cnts[1]
-            else:
-                cnt_2nd = 0
-            p_1 = cnt_1st / cnt_all
-            p_2 = cnt_2nd / cnt_all
-            if calibrated and self._A is not None:
-                p_1 = len([x for x in self._A if x >= p_1]) / len(self._A)
-                p_2 = len([x for x in self._A if x >= p_2]) / len(self._A)
-            knn_pred.append(label)
-            knn_cred.append(p_1)
-            knn_conf.append(1 - p_2)
+        counts, first = vote(knn_logits, self.n_class)
+        cnt_all = np.maximum(counts.sum(axis=1), 1)
+        # most common label. like Counter.most_common, ties go to the
+        # label that comes first among the neighbors
+        knn_pred = np.argmax(counts * (first.max() + 1) - first, axis=1)
+        cnt_1st = counts[np.arange(batch_size), knn_pred]
+        if self.n_class > 1:
+            cnt_2nd = np.partition(counts, -2, axis=1)[:, -2]
+        else:
+            cnt_2nd = np.zeros(batch_size, counts.dtype)
+        p_1 = cnt_1st / cnt_all
+        p_2 = cnt_2nd / cnt_all
+        if calibrated and self._A is not None:
+            # credibility of the predicted label and of the runner up, whose
+            # complement is the confidence
+            p_1 = self._calibrated(p_1)
+            p_2 = self._calibrated(p_2)
+        knn_pred, knn_cred, knn_conf = (
+            knn_pred.tolist(), p_1.tolist(), (1 - p_2).tolist())
         return knn_pred, knn_cred, knn_conf, reg_pred, reg_conf
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--gpu', '-g', type=int, default=0,
                         help='GPU ID (negative value indicates CPU)')
@@ -285,54 +727,147 @@ def main():
     parser.add_argument('--lsh', action='store_true', default=False,
                         help='If true, uses locally sensitive hashing \
                               (with k=10 NN) for NN search.')
-    args = parser.parse_args()
+    parser.add_argument('--algorithm', choices=('kd_tree', 'brute', 'ivf'),
+                        default='kd_tree',
+                        help='Nearest neighbor search used without --lsh. \
+                              ivf is an approximate search on disk, built \
+                              out of core for training sets larger than \
+                              memory.')
+    parser.add_argument('--storage', choices=STORAGES, default='float32',
+                        help='Precision of the activations stored in the \
+                              index (float16 needs --algorithm brute or \
+                              ivf, int8 --algorithm brute).')
+    parser.add_argument('--n-lists', type=int, default=None,
+                        help='Number of lists of --algorithm ivf (default: \
+                              the square root of the training set size).')
+    parser.add_argument('--n-probe', type=int, default=16,
+                        help='Number of lists searched by each query of \
+                              --algorithm ivf.')
+    parser.add_argument('--work-dir', default=None,
+                        help='Directory --algorithm ivf writes the \
+                              activations and the index to (default: the \
+                              --save-index directory, or a temporary one).')
+    parser.add_argument('--storage-report', action='store_true',
+                        default=False,
+                        help='Compare the predictions and credibility of \
+                              float16 and int8 indexes with float32 ones \
+                              on the evaluation data.')
+    parser.add_argument('--reduction', choices=REDUCTIONS, default=None,
+                        help='Project the activations of each indexed \
+                              layer before the nearest neighbor search, \
+                              with PCA or a gaussian or sparse random \
+                              projection.')
+    parser.add_argument('--n-components', type=int, default=64,
+                        help='Number of dimensions kept by --reduction.')
+    parser.add_argument('--metric', choices=('euclidean', 'cosine'),
+                        default='euclidean',
+                        help='Distance of the nearest neighbor search.')
+    parser.add_argument('--save-index', default=None,
+                        help='Directory to save the built and calibrated \
+                              index to.')
+    parser.add_argument('--load-index', default=None,
+                        help='Directory of an index saved with \
+                              --save-index, used instead of building one.')
+    parser.add_argument('--recalibrate', action='store_true', default=False,
+                        help='Score the calibration set again even if the \
+                              index loaded with --load-index is calibrated, \
+                              e.g. after a model change.')
+    parser.add_argument('--early-exit', action='store_true', default=False,
+                        help='Stop the neighbor vote (and the lsh search) \
+                              of an evaluation example once its dknn \
+                              prediction is decided.')
+    parser.add_argument('--dtype', choices=('float32', 'float16'),
+                        default=None,
+                        help='Cast the parameters of the model to this \
+                              dtype to run it in half precision (float16 \
+                              is meant for GPUs). Activations are indexed \
+                              as float32 unless --storage is set.')
+    parser.add_argument('--report', default=None,
+                        help='Directory to stream the predictions, \
+                              confidence and credibility of each evaluation \
+                              example to, with a summary.json of accuracy \
+                              per class, length and credibility, and \
+                              coverage against accuracy.')
+    parser.add_argument('--layers', type=int, nargs='+', default=None,
+                        help='Ids of the layers to index (default: all \
+                              layers with --lsh, the last one otherwise).')
+    args = parser.parse_args(argv)
+    if args.storage_report and args.load_index is not None:
+        parser.error('--storage-report needs the activations of a new index')
+    if args.storage_report and args.algorithm == 'ivf':
+        parser.error('--storage-report needs the activations in memory, '
+                     'which --algorithm ivf does not keep')
 
     model, train, test, vocab, setup = setup_model(args)
-    if setup['dataset'] == 'snli':
-        converter = convert_snli_seq
-        use_snli = True
-    else:
-        converter = convert_seq
-        use_snli = False
+    use_snli = setup['dataset'] == 'snli'
+    converter = PackedSeqConverter(snli=use_snli)
 
     with open(os.path.join(setup['save_path'], 'calib.json')) as f:
         calibration_idx = json.load(f)
 
-    calibration = [train[i] for i in calibration_idx]
-    train = [x for i, x in enumerate(train) if i not in calibration_idx]
+    train, calibration = split_calibration(train, calibration_idx)
+    if not use_snli:
+        train = RaggedDataset.from_examples(train)
 
     '''save dknn layers for training data'''
-    dknn = DkNN(model, lsh=args.lsh)
-    dknn.build(train, batch_size=setup['batchsize'],
-               converter=converter, device=args.gpu)
+    if args.load_index is not None:
+        dknn = DkNN.load(model, args.load_index)
+    else:
+        algorithm = 'lsh' if args.lsh else args.algorithm
+        dknn = DkNN(model, layer_ids=args.layers, algorithm=algorithm,
+                    storage=args.storage, reduction=args.reduction,
+                    n_components=args.n_components, metric=args.metric,
+                    n_lists=args.n_lists, n_probe=args.n_probe,
+                    work_dir=args.work_dir or args.save_index)
+        dknn.build(train, batch_size=setup['batchsize'],
+                   converter=converter, device=args.gpu)
 
     '''calibrate the dknn credibility values'''
-    dknn.calibrate(calibration, batch_size=setup['batchsize'],
-                   converter=converter, device=args.gpu)
+    if dknn._A is None or args.recalibrate:
+        dknn.calibrate(calibration, batch_size=setup['batchsize'],
+                       converter=converter, device=args.gpu)
+    if args.save_index is not None:
+        if args.load_index is None:  # neighbors can be shown as text
+            dknn.set_text_store(train, vocab, setup['char_based'])
+        dknn.save(args.save_index)
 
     '''run dknn on evaluation data'''
-    test_iter = chainer.iterators.SerialIterator(
-            test, setup['batchsize'], repeat=False)
-    test_iter.reset()
+    test_iter = BucketIterator(
+            test, setup['batchsize'], repeat=False, shuffle=False)
+    n_batches = test_iter.n_batches
+    test_iter = PrefetchIterator(test_iter, converter, args.gpu)
 
     print('run dknn on evaluation data')
 
-    total = 0
-    n_reg_correct = 0
-    n_knn_correct = 0
-    n_batches = len(test) // setup['batchsize']
-    for test_batch in tqdm(test_iter, total=n_batches):
-        data = converter(test_batch, device=args.gpu, with_label=True)
+    # calibration of the softmax confidence and of the calibrated
+    # dknn credibility, and the other aggregates of the report. with
+    # --report, each example is also written out as the batches go
+    report = EvaluationReport(args.report)
+    for data in tqdm(test_iter, total=n_batches):
         text = data['xs']
         knn_pred, knn_cred, knn_conf, reg_pred, reg_conf = dknn.predict(
-                text, snli=use_snli)
-        label = [int(x) for x in data['ys']]
-        total += len(label)
-        n_knn_correct += sum(x == y for x, y in zip(knn_pred, label))
-        n_reg_correct += sum(x == y for x, y in zip(reg_pred, label))
-
-    print('knn accuracy', n_knn_correct / total)
-    print('reg accuracy', n_reg_correct / total)
+                text, calibrated=True, snli=use_snli,
+                early_exit=args.early_exit)
+        label = np.array([int(x) for x in data['ys']])
+        report.update(label, batch_lengths(text, use_snli), reg_pred,
+                      reg_conf, knn_pred, knn_cred, knn_conf,
+                      index=test_iter.batch_indices)
+    test_iter.finalize()
+    report.close()
+
+    print('knn accuracy', report.knn_metrics.accuracy)
+    print('reg accuracy', report.reg_metrics.accuracy)
+    print('knn calibration', json.dumps(report.knn_metrics.summary()))
+    print('reg calibration', json.dumps(report.reg_metrics.summary()))
+    if args.report is not None:
+        print('evaluation report written to', args.report)
+    if args.early_exit:
+        print('skipped neighbor search', dknn.skipped_search)
+
+    if args.storage_report:
+        report = dknn.storage_drift(test, batch_size=setup['batchsize'],
+                                    converter=converter, device=args.gpu)
+        print('index storage', json.dumps(report))
 
 
 if __name__ == '__main__':
@@ -2,23 +2,27 @@
 import os
 import json
 import argparse
+import warnings
 import numpy as np
-import cupy as cp
 
 import chainer
 import chainer.functions as F
+from chainer.backends import cuda
 
-from nlp_utils import convert_seq, convert_snli_seq
-from utils import setup_model
+from iterators import BucketIterator, restore_order
+from metrics import CalibrationMetrics
+from nets import inference_mode
+from nlp_utils import PackedSeqConverter
+from utils import setup_model, load_split
 
 ''' Takes the logits and divides by a temperature parameter '''
 class TemperatureScaler(chainer.Link):
 
-    def __init__(self):
+    def __init__(self, temperature=1.5):
         super(TemperatureScaler, self).__init__()
         with self.init_scope():
             self.temperature = chainer.Parameter(
-                    np.asarray([1.5], dtype=np.float32))
+                    np.asarray([temperature], dtype=np.float32))
 
     def __call__(self, logits):
         return logits / F.broadcast_to(self.temperature, logits.shape)
@@ -31,42 +35,99 @@ class ScaledModel(chainer.Chain):
         with self.init_scope():
             self.model = model
             self.temperature = TemperatureScaler()
-        if model.xp == cp:
+        if model.xp is not np:
             self.temperature.to_gpu()
 
     def predict(self, xs):
         return self.temperature(self.model.predict(xs, no_dropout=True))
 
-''' See "On Calibration of Modern Neural Networks for details". Defines the loss
-function for fitting the temperature parameter. See this code also
+''' See "On Calibration of Modern Neural Networks for details". Expected
+calibration error of the softmax of the logits, computed in one pass with
+metrics.CalibrationMetrics. See this code also
 https://github.com/gpleiss/temperature_scaling'''
 class ECELoss:
 
     def __init__(self, n_bins=15):
-        bin_boundaries = np.linspace(0, 1, n_bins+1)
-        self.bin_lowers = bin_boundaries[:-1]
-        self.bin_uppers = bin_boundaries[1:]
-
-    def __call__(self, logits, labels):        
-        scores = cp.asnumpy(F.softmax(logits).data)
-        labels = cp.asnumpy(labels.data)
-        predictions = np.argmax(scores, axis=1)
-        confidences = np.max(scores, axis=1)
-        accuracies = (predictions == labels)
-        total_count = accuracies.shape[0]
-        ece = 0
-        for lower, upper in zip(self.bin_lowers, self.bin_uppers):
-            in_bin = np.greater(confidences, lower) * \
-                     np.less_equal(confidences, upper)
-            count = in_bin.sum()
-            if count > 0:
-                conf_in_bin = (confidences * in_bin).sum() / count
-                acc_in_bin = (accuracies * in_bin).sum() / count
-                ece += np.abs(conf_in_bin - acc_in_bin) * count / total_count
-        return ece
-
-
-def main():
+        self.n_bins = n_bins
+
+    def __call__(self, logits, labels):
+        scores = cuda.to_cpu(F.softmax(logits).data)
+        labels = cuda.to_cpu(chainer.as_variable(labels).data)
+        metrics = CalibrationMetrics(self.n_bins)
+        metrics.update(scores, labels)
+        return metrics.ece
+
+
+''' runs the model once over data and returns its logits and labels, in
+dataset order. Only the temperature is fitted, so the logits of the
+calibration set never change '''
+def collect_logits(model, data, converter, device, batch_size=64):
+    data_iter = BucketIterator(data, batch_size, repeat=False, shuffle=False)
+    all_logits, all_labels, all_indices = [], [], []
+    with inference_mode():
+        for batch in data_iter:
+            all_indices.append(data_iter.batch_indices)
+            batch = converter(batch, device=device, with_label=True)
+            logits = model.predict(batch['xs'], no_dropout=True)
+            labels = F.concat(batch['ys'], axis=0)
+            all_logits.append(cuda.to_cpu(logits.data))
+            all_labels.append(cuda.to_cpu(labels.data))
+    indices = np.concatenate(all_indices)
+    return (restore_order(np.concatenate(all_logits), indices),
+            restore_order(np.concatenate(all_labels), indices))
+
+
+''' negative log likelihood of labels under softmax(logits / temperature) '''
+def temperature_nll(logits, labels, temperature):
+    z = logits / temperature
+    z = z - z.max(axis=1, keepdims=True)
+    log_probs = z - np.log(np.exp(z).sum(axis=1, keepdims=True))
+    return -log_probs[np.arange(len(labels)), labels].mean()
+
+
+''' fits the temperature on cached logits by golden-section search on the
+NLL. The NLL is convex in the inverse temperature, so the search runs
+over 1 / T in [1 / upper, 1 / lower] until the bracket is smaller than tol.
+A result on an edge of the bracket means the optimum may lie outside it:
+the bracket is then widened tenfold on that side, up to max_widen times,
+and a warning is given if the result still ends up on an edge
+'''
+def fit_temperature(logits, labels, lower=0.05, upper=20., tol=1e-6,
+                    max_widen=2):
+    logits = np.asarray(logits, dtype=np.float64)
+    labels = np.asarray(labels)
+
+    def nll(beta):
+        return temperature_nll(logits, labels, 1. / beta)
+
+    inv_phi = (np.sqrt(5.) - 1.) / 2.
+    for widen in range(max_widen + 1):
+        a, b = lo, hi = 1. / upper, 1. / lower
+        c, d = b - inv_phi * (b - a), a + inv_phi * (b - a)
+        nll_c, nll_d = nll(c), nll(d)
+        while b - a > tol:
+            if nll_c < nll_d:
+                b, d, nll_d = d, c, nll_c
+                c = b - inv_phi * (b - a)
+                nll_c = nll(c)
+            else:
+                a, c, nll_c = c, d, nll_d
+                d = a + inv_phi * (b - a)
+                nll_d = nll(d)
+        at_upper, at_lower = a - lo < tol, hi - b < tol
+        if not (at_upper or at_lower):
+            break
+        if widen < max_widen:
+            upper, lower = (upper * 10., lower) if at_upper else \
+                (upper, lower / 10.)
+    else:
+        warnings.warn('the fitted temperature {:g} is on the edge of the '
+                      'search bracket [{:g}, {:g}], the optimum may lie '
+                      'outside of it'.format(2. / (a + b), lower, upper))
+    return 2. / (a + b)
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--gpu', '-g', type=int, default=0,
                         help='GPU ID (negative value indicates CPU)')
@@ -75,53 +136,53 @@ def main():
     parser.add_argument('--lsh', action='store_true', default=False,
                         help='If true, uses locally sensitive hashing \
                               (with k=10 NN) for NN search.')
-    args = parser.parse_args()
-
-    model, train, test, vocab, setup = setup_model(args)
-    if setup['dataset'] == 'snli':
-        converter = convert_snli_seq
-        use_snli = True
+    parser.add_argument('--recompute-logits', action='store_true',
+                        default=False,
+                        help='Ignore the cached calibration logits.')
+    args = parser.parse_args(argv)
+
+    # the training split is only read if the logits are not cached
+    model, _, _, vocab, setup = setup_model(args, splits=())
+    use_snli = setup['dataset'] == 'snli'
+    converter = PackedSeqConverter(snli=use_snli)
+
+    # the logits of the calibration set are cached next to calib.json and
+    # recomputed when the model is newer than the cache
+    logits_path = os.path.join(setup['save_path'], 'calib_logits.npz')
+    if not args.recompute_logits and os.path.exists(logits_path) and \
+            os.path.getmtime(logits_path) >= \
+            os.path.getmtime(setup['model_path']):
+        cached = np.load(logits_path)
+        logits, labels = cached['logits'], cached['labels']
     else:
-        converter = convert_seq
-        use_snli = False
-
-    with open(os.path.join(setup['save_path'], 'calib.json')) as f:
-        calibration_idx = json.load(f)
-
-    calibration = [train[i] for i in calibration_idx]
-    train = [x for i, x in enumerate(train) if i not in calibration_idx]
-
-    sm = ScaledModel(model)
-
-    optim = chainer.optimizers.Adam()
-    optim.setup(sm.temperature)
-
-    calib_iter = chainer.iterators.SerialIterator(
-            calibration, setup['batchsize'], repeat=False)
-    eceloss = ECELoss()
-
-    num_epochs = 50
-    for i in range(num_epochs):
-        calib_iter.reset()
-        all_logits = []
-        all_labels = []
-        for i, batch in enumerate(calib_iter):
-            batch = converter(batch, device=args.gpu, with_label=True)
-            logits = sm.predict(batch['xs'])
-            labels = F.concat(batch['ys'], axis=0)
-            all_logits.append(logits.data)
-            all_labels.append(labels.data)
-        all_logits = F.concat(all_logits, axis=0)
-        all_labels = F.concat(all_labels, axis=0)
-
-        print(sm.temperature.temperature.data[0],
-              eceloss(all_logits, all_labels))
-
-        logits = sm.temperature(all_logits)
-        loss = F.softmax_cross_entropy(logits, all_labels)
-        sm.temperature.zerograds()
-        loss.backward()
-        optim.update()
+        with open(os.path.join(setup['save_path'], 'calib.json')) as f:
+            calibration_idx = json.load(f)
+        train = load_split(setup, 'train', vocab)
+        calibration = [train[i] for i in calibration_idx]
+        logits, labels = collect_logits(model, calibration, converter,
+                                        args.gpu, setup['batchsize'])
+        np.savez(logits_path, logits=logits, labels=labels)
+
+    temperature = fit_temperature(logits, labels)
+
+    result = {'temperature': temperature}
+    for name, t in [('before', 1.), ('after', temperature)]:
+        metrics = CalibrationMetrics()
+        metrics.update(F.softmax(logits / np.float32(t)).data, labels)
+        for key, value in metrics.summary().items():
+            result['{}_{}'.format(key, name)] = value
+    print(json.dumps(result, indent=2))
+
+    with open(os.path.join(setup['save_path'], 'temperature.json'), 'w') as f:
+        json.dump(result, f)
+
+    # store the temperature with the model setup, so that setup_model
+    # applies it to the predicted probabilities
+    with open(args.model_setup) as f:
+        model_setup = json.load(f)
+    model_setup['temperature'] = temperature
+    with open(args.model_setup, 'w') as f:
+        json.dump(model_setup, f)
 
 
 if __name__ == '__main__':
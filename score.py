@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+import sys
+import argparse
+
+from chainer.backends import cuda
+
+import numpy
+
+from nets import inference_mode
+from nlp_utils import PackedSeqConverter, VocabEncoder
+from utils import setup_model
+
+'''scores raw sentences with a trained model. only the model and its
+vocabulary are loaded, no dataset is read'''
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gpu', '-g', type=int, default=-1,
+                        help='GPU ID (negative value indicates CPU)')
+    parser.add_argument('--model-setup', required=True,
+                        help='Model setup dictionary.')
+    parser.add_argument('sentences', nargs='*',
+                        help='Sentences to score. Read from stdin, one per \
+                              line, if none are given.')
+    args = parser.parse_args(argv)
+
+    model, _, _, vocab, setup = setup_model(args, splits=())
+    if setup['dataset'] == 'snli':
+        parser.error('scoring single sentences is not supported for snli')
+
+    sentences = args.sentences or [l.rstrip('\n') for l in sys.stdin]
+    # all sentences are tokenized and looked up in the vocabulary at once
+    tokens, offsets = VocabEncoder(vocab, setup['char_based']).encode(
+        sentences)
+    xs = numpy.split(tokens, offsets[1:-1])
+    xs = PackedSeqConverter()(xs, device=args.gpu, with_label=False)
+    with inference_mode():
+        probs = cuda.to_cpu(model.predict(xs, softmax=True))
+
+    # prediction, its probability and the sentence, tab separated
+    for sentence, p in zip(sentences, probs):
+        print('{}\t{:.4f}\t{}'.format(int(p.argmax()), float(p.max()),
+                                      sentence))
+
+
+if __name__ == '__main__':
+    main()
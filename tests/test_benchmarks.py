@@ -0,0 +1,16 @@
+import pytest
+
+import benchmarks
+
+
+def test_import_time_runs(capsys):
+    benchmarks.main(['import-time', '--repeat', '1', 'cli'])
+    assert 'cli' in capsys.readouterr().out
+
+
+def test_dknn_reaches_the_model_setup(tmp_path):
+    pytest.importorskip('chainer')
+    # the arguments are dumped as json before the setup is opened
+    with pytest.raises(IOError):
+        benchmarks.main(['dknn', '--model-setup',
+                         str(tmp_path / 'args.json'), '--gpu', '-1'])
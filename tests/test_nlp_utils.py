@@ -0,0 +1,23 @@
+import pytest
+
+pytest.importorskip('chainer')
+
+from nlp_utils import count_tokens  # noqa: E402
+
+
+def records(n, bad=None):
+    for i in range(n):
+        yield ((None if i == bad else 'w{} x'.format(i % 7),), 0)
+
+
+def test_count_tokens_in_workers_matches_serial():
+    serial = count_tokens(records(500), n_workers=1, chunk_size=3)
+    parallel = count_tokens(records(500), n_workers=2, chunk_size=3)
+    assert parallel == serial
+
+
+def test_worker_error_reaches_caller():
+    # many more chunks than are read ahead, so the pool still waits for
+    # chunks when the error comes back
+    with pytest.raises(AttributeError):
+        count_tokens(records(100000, bad=1000), n_workers=2, chunk_size=2)
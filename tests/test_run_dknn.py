@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('chainer')
+
+from run_dknn import DkNN  # noqa: E402
+
+
+class Model(object):
+    n_dknn_layers = 2
+
+
+def test_calibrated_counts_tied_scores():
+    dknn = DkNN(Model())
+    dknn._A = np.array([0.5, 1., 1., 1.])
+    # all of the 75 neighbors agree: at least as conforming as every
+    # calibration example
+    assert dknn._calibrated(1.) == 1.
+    assert dknn._calibrated(0.5) == 0.25
+    assert dknn._calibrated(0.4) == 0.
+
+
+def test_calibrated_rises_with_agreement():
+    dknn = DkNN(Model())
+    dknn._A = np.sort(np.random.RandomState(0).randint(0, 76, 200) / 75.)
+    credibility = dknn._calibrated(np.arange(76) / 75.)
+    assert np.all(np.diff(credibility) >= 0)
+    assert credibility[-1] == 1.
+
+
+def test_early_exit_searches_no_more_than_full_vote():
+    from knn_index import BruteForceIndex
+    from run_dknn import vote
+
+    rng = np.random.RandomState(0)
+    train = rng.randn(300, 8).astype(np.float32)
+    test = rng.randn(40, 8).astype(np.float32)
+    dknn = DkNN(Model(), algorithm='brute')
+    dknn.tree_list = [BruteForceIndex(train)]
+    dknn.label_list = (train[:, 0] > 0).astype(np.int32)
+    dknn.n_class = 2
+
+    knn_logits = dknn._early_exit_labels([test])
+    assert dknn.skipped_search >= 0
+    _, knn = dknn.tree_list[-1].query(test, k=75)
+    full = vote(dknn.label_list[knn], 2)[0].argmax(axis=1)
+    early = vote(knn_logits, 2)[0].argmax(axis=1)
+    np.testing.assert_array_equal(early, full)
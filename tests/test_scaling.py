@@ -0,0 +1,42 @@
+import warnings
+
+import numpy as np
+import pytest
+
+pytest.importorskip('chainer')
+
+from scaling import fit_temperature  # noqa: E402
+
+
+def sample(temperature, n=5000, seed=0):
+    # labels drawn from the softmax of logits / temperature, so the
+    # fitted temperature should be close to temperature
+    rng = np.random.RandomState(seed)
+    logits = rng.randn(n, 4) * 5
+    probs = np.exp(logits / temperature)
+    probs /= probs.sum(axis=1, keepdims=True)
+    labels = np.array([rng.choice(4, p=p) for p in probs])
+    return logits, labels
+
+
+def test_fit_temperature_inside_bracket():
+    logits, labels = sample(2.)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert abs(fit_temperature(logits, labels) - 2.) < 0.2
+
+
+def test_fit_temperature_widens_bracket():
+    logits, labels = sample(50.)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert abs(fit_temperature(logits, labels) - 50.) < 15.
+
+
+def test_fit_temperature_warns_on_edge():
+    # the logits of the true label are the lowest, so the nll keeps falling
+    # as the temperature rises
+    labels = np.random.RandomState(0).randint(0, 4, 1000)
+    logits = -np.eye(4)[labels]
+    with pytest.warns(UserWarning, match='edge'):
+        fit_temperature(logits, labels)
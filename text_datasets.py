@@ -12,11 +12,11 @@ import numpy
 
 import chainer
 
-from nlp_utils import make_vocab
+from nlp_utils import count_tokens
+from nlp_utils import encode_records
 from nlp_utils import normalize_text
 from nlp_utils import split_text
-from nlp_utils import transform_to_array
-from nlp_utils import transform_snli_to_array
+from nlp_utils import vocab_from_counts
 
 URL_DBPEDIA = 'https://github.com/le-scientifique/torchDatasets/raw/master/dbpedia_csv.tar.gz'  # NOQA
 URL_IMDB = 'https://ai.stanford.edu/~amaas/data/sentiment/aclImdb_v1.tar.gz'
@@ -30,32 +30,38 @@ def download_dbpedia():
     return tf
 
 
-def read_dbpedia(tf, split, shrink=1, char_based=False):
-    dataset = []
+def iter_dbpedia(tf, split, shrink=1):
     f = tf.extractfile('dbpedia_csv/{}.csv'.format(split))
-    f = io.StringIO(f.read().decode('utf-8'))
-    for i, (label, title, text) in enumerate(csv.reader(f)):
-        if i % shrink != 0:
-            continue
-        label = int(label) - 1  # Index begins from 1
-        tokens = split_text(normalize_text(text), char_based)
-        dataset.append((tokens, label))
-    return dataset
+    # newline='' keeps the newlines of quoted fields for the csv reader
+    with io.TextIOWrapper(f, encoding='utf-8', newline='') as f:
+        for i, (label, title, text) in enumerate(csv.reader(f)):
+            if i % shrink != 0:
+                continue
+            yield (text, ), int(label) - 1  # Index begins from 1
+
+
+def read_dbpedia(tf, split, shrink=1, char_based=False):
+    return [(split_text(normalize_text(text), char_based), label)
+            for (text, ), label in iter_dbpedia(tf, split, shrink=shrink)]
 
 
-def get_dbpedia(vocab=None, shrink=1, char_based=False):
+def get_dbpedia(vocab=None, shrink=1, char_based=False, n_workers=None):
     tf = download_dbpedia()
 
     print('read dbpedia')
-    train = read_dbpedia(tf, 'train', shrink=shrink, char_based=char_based)
-    test = read_dbpedia(tf, 'test', shrink=shrink, char_based=char_based)
+
+    def records(split):
+        return iter_dbpedia(tf, split, shrink=shrink)
 
     if vocab is None:
         print('constract vocabulary based on frequency')
-        vocab = make_vocab(train)
+        vocab = vocab_from_counts(count_tokens(
+            records('train'), char_based=char_based, n_workers=n_workers))
 
-    train = transform_to_array(train, vocab)
-    test = transform_to_array(test, vocab)
+    train = encode_records(records('train'), vocab,
+                           char_based=char_based, n_workers=n_workers)
+    test = encode_records(records('test'), vocab,
+                          char_based=char_based, n_workers=n_workers)
 
     return train, test, vocab
 
@@ -69,53 +75,56 @@ def download_imdb():
     return path
 
 
-def read_imdb(path, split,
-              shrink=1, fine_grained=False, char_based=False):
+def iter_imdb(path, split, shrink=1, fine_grained=False):
     fg_label_dict = {'1': 0, '2': 0, '3': 1, '4': 1,
                      '7': 2, '8': 2, '9': 3, '10': 3}
 
     def read_and_label(posneg, label):
-        dataset = []
         target = os.path.join(path, 'aclImdb', split, posneg, '*')
         for i, f_path in enumerate(glob.glob(target)):
             if i % shrink != 0:
                 continue
             with io.open(f_path, encoding='utf-8', errors='ignore') as f:
                 text = f.read().strip()
-            tokens = split_text(normalize_text(text), char_based)
             if fine_grained:
                 # extract from f_path. e.g. /pos/200_8.txt -> 8
                 label = fg_label_dict[f_path.split('_')[-1][:-4]]
-                dataset.append((tokens, label))
-            else:
-                dataset.append((tokens, label))
-        return dataset
+            yield (text, ), label
 
-    pos_dataset = read_and_label('pos', 0)
-    neg_dataset = read_and_label('neg', 1)
-    return pos_dataset + neg_dataset
+    for record in read_and_label('pos', 0):
+        yield record
+    for record in read_and_label('neg', 1):
+        yield record
+
+
+def read_imdb(path, split,
+              shrink=1, fine_grained=False, char_based=False):
+    return [(split_text(normalize_text(text), char_based), label)
+            for (text, ), label in iter_imdb(
+                path, split, shrink=shrink, fine_grained=fine_grained)]
 
 
 def get_imdb(vocab=None, shrink=1, fine_grained=False,
-             char_based=False):
+             char_based=False, n_workers=None):
     tmp_path = download_imdb()
 
     print('read imdb')
-    train = read_imdb(tmp_path, 'train',
-                      shrink=shrink, fine_grained=fine_grained,
-                      char_based=char_based)
-    test = read_imdb(tmp_path, 'test',
-                     shrink=shrink, fine_grained=fine_grained,
-                     char_based=char_based)
 
-    shutil.rmtree(tmp_path)
+    def records(split):
+        return iter_imdb(tmp_path, split,
+                         shrink=shrink, fine_grained=fine_grained)
 
     if vocab is None:
         print('constract vocabulary based on frequency')
-        vocab = make_vocab(train)
+        vocab = vocab_from_counts(count_tokens(
+            records('train'), char_based=char_based, n_workers=n_workers))
 
-    train = transform_to_array(train, vocab)
-    test = transform_to_array(test, vocab)
+    train = encode_records(records('train'), vocab,
+                           char_based=char_based, n_workers=n_workers)
+    test = encode_records(records('test'), vocab,
+                          char_based=char_based, n_workers=n_workers)
+
+    shutil.rmtree(tmp_path)
 
     return train, test, vocab
 
@@ -135,41 +144,49 @@ def download_other_dataset(name):
     return file_paths
 
 
-def read_other_dataset(path, shrink=1, char_based=False):
-    dataset = []
+def iter_other_dataset(path, shrink=1):
     with io.open(path, encoding='utf-8', errors='ignore') as f:
         for i, l in enumerate(f):
             if i % shrink != 0 or not len(l.strip()) >= 3:
                 continue
             label, text = l.strip().split(None, 1)
-            label = int(label)
-            tokens = split_text(normalize_text(text), char_based)
-            dataset.append((tokens, label))
-    return dataset
+            yield (text, ), int(label)
 
 
-def get_other_text_dataset(name, vocab=None, shrink=1,
-                           char_based=False, seed=777):
-    assert(name in ['TREC', 'stsa.binary', 'stsa.fine',
-                    'custrev', 'mpqa', 'rt-polarity', 'subj'])
-    datasets = download_other_dataset(name)
-    train = read_other_dataset(
-        datasets[0], shrink=shrink, char_based=char_based)
+def read_other_dataset(path, shrink=1, char_based=False):
+    return [(split_text(normalize_text(text), char_based), label)
+            for (text, ), label in iter_other_dataset(path, shrink=shrink)]
+
+
+def split_other_dataset(datasets, shrink=1, seed=777):
+    train = list(iter_other_dataset(datasets[0], shrink=shrink))
     if len(datasets) == 2:
-        test = read_other_dataset(
-            datasets[1], shrink=shrink, char_based=char_based)
+        test = list(iter_other_dataset(datasets[1], shrink=shrink))
     else:
         numpy.random.seed(seed)
-        alldata = numpy.random.permutation(train)
+        order = numpy.random.permutation(len(train))
+        alldata = [train[i] for i in order]
         train = alldata[:-len(alldata) // 10]
         test = alldata[-len(alldata) // 10:]
+    return train, test
+
+
+def get_other_text_dataset(name, vocab=None, shrink=1,
+                           char_based=False, seed=777, n_workers=None):
+    assert(name in ['TREC', 'stsa.binary', 'stsa.fine',
+                    'custrev', 'mpqa', 'rt-polarity', 'subj'])
+    train, test = split_other_dataset(
+        download_other_dataset(name), shrink=shrink, seed=seed)
 
     if vocab is None:
         print('constract vocabulary based on frequency')
-        vocab = make_vocab(train)
+        vocab = vocab_from_counts(count_tokens(
+            train, char_based=char_based, n_workers=n_workers))
 
-    train = transform_to_array(train, vocab)
-    test = transform_to_array(test, vocab)
+    train = encode_records(train, vocab,
+                           char_based=char_based, n_workers=n_workers)
+    test = encode_records(test, vocab,
+                          char_based=char_based, n_workers=n_workers)
 
     return train, test, vocab
 
@@ -187,12 +204,11 @@ def most_common(lst):
     return max(set(lst), key=lst.count)
 
 
-def read_snli(path, split, shrink=1, char_based=False):
+def iter_snli(path, split, shrink=1):
     path = os.path.join(path, 'snli_1.0_{}.jsonl'.format(split))
-    dataset = []
     labels = {'entailment': 0, 'neutral': 1, 'contradiction': 2}
-    with open(path) as f:
-        for i, x in enumerate(f.readlines()):            
+    with io.open(path, encoding='utf-8') as f:
+        for i, x in enumerate(f):
             if i % shrink != 0:
                 continue
             x = json.loads(x)
@@ -200,28 +216,59 @@ def read_snli(path, split, shrink=1, char_based=False):
                 label = labels[x['gold_label']]
             else:
                 label = labels[most_common(x['annotator_labels'])]
-            premise = split_text(normalize_text(x['sentence1']), char_based)
-            hypothesis = split_text(normalize_text(x['sentence2']), char_based)
-            dataset.append((premise, hypothesis, label))
-    return dataset
+            yield (x['sentence1'], x['sentence2']), label
+
 
+def read_snli(path, split, shrink=1, char_based=False):
+    return [(split_text(normalize_text(premise), char_based),
+             split_text(normalize_text(hypothesis), char_based), label)
+            for (premise, hypothesis), label in iter_snli(
+                path, split, shrink=shrink)]
 
-def get_snli(vocab=None, shrink=1, char_based=False):
+
+def get_snli(vocab=None, shrink=1, char_based=False, n_workers=None):
     path = download_snli()
 
     print('read snli')
     path = 'snli_1.0'
-    train = read_snli(path, 'train', shrink=shrink, char_based=char_based)
-    test = read_snli(path, 'dev', shrink=shrink, char_based=char_based)
+
+    def records(split):
+        return iter_snli(path, split, shrink=shrink)
 
     if vocab is None:
+        # premises and hypotheses share the vocabulary
         print('construct vocabulary based on frequency')
-        train_premise = [(x, z) for x, y, z in train]
-        train_hypothesis = [(y, z) for x, y, z in train]
-        train_all = train_premise + train_hypothesis
-        vocab = make_vocab(train_all)
+        vocab = vocab_from_counts(count_tokens(
+            records('train'), char_based=char_based, n_workers=n_workers))
 
-    train = transform_snli_to_array(train, vocab, combine=combine)
-    test = transform_snli_to_array(test, vocab, combine=combine)
+    train = encode_records(records('train'), vocab,
+                           char_based=char_based, n_workers=n_workers)
+    test = encode_records(records('dev'), vocab,
+                          char_based=char_based, n_workers=n_workers)
 
-    return train, test, vocab
\ No newline at end of file
+    return train, test, vocab
+
+
+def get_dataset_split(name, split, vocab, char_based=False, n_workers=None):
+    '''reads a single split ('train' or 'test') of a dataset and encodes it
+    with an existing vocabulary, e.g. the one saved with a model'''
+    assert split in ['train', 'test']
+    if name == 'dbpedia':
+        records = iter_dbpedia(download_dbpedia(), split)
+    elif name == 'snli':
+        download_snli()
+        records = iter_snli('snli_1.0', 'train' if split == 'train' else 'dev')
+    elif name.startswith('imdb.'):
+        tmp_path = download_imdb()
+        data = encode_records(
+            iter_imdb(tmp_path, split, fine_grained=name.endswith('.fine')),
+            vocab, char_based=char_based, n_workers=n_workers)
+        shutil.rmtree(tmp_path)
+        return data
+    else:
+        assert(name in ['TREC', 'stsa.binary', 'stsa.fine',
+                        'custrev', 'mpqa', 'rt-polarity', 'subj'])
+        train, test = split_other_dataset(download_other_dataset(name))
+        records = train if split == 'train' else test
+    return encode_records(records, vocab,
+                          char_based=char_based, n_workers=n_workers)
@@ -5,15 +5,16 @@ import argparse
 import datetime
 import pickle
 import random
-import numpy as np
 
 import chainer
 from chainer import training
 from chainer.training import extensions
 
 import nets
-from nlp_utils import convert_seq, convert_snli_seq
+from iterators import BucketIterator, PrefetchIterator, identity_converter
+from nlp_utils import PackedSeqConverter, RaggedDataset, load_word_vectors
 import text_datasets
+from utils import split_calibration
 
 ''' trains a classification model and saves it. Can then be used for
 regular inference or for dknn'''
@@ -46,36 +47,51 @@ def create_parser():
     parser.add_argument('--char-based', action='store_true')
     parser.add_argument('--word_vectors', default=None,
                         help='word vector directory')
+    parser.add_argument('--bucket', action='store_true', default=False,
+                        help='batch examples of similar length together')
+    parser.add_argument('--max-tokens', type=int, default=None,
+                        help='with --bucket, limit the padded number of \
+                              tokens per training batch')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='Number of batches converted ahead in a \
+                              background thread (0 disables prefetching)')
+    parser.add_argument('--n-workers', type=int, default=None,
+                        help='Number of processes used to tokenize the \
+                              corpus (default: number of CPUs)')
     return parser
 
 
-def main():
+def main(argv=None):
     parser = create_parser()
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.max_tokens is not None and not args.bucket:
+        parser.error('--max-tokens needs --bucket')
     current_datetime = '{}'.format(datetime.datetime.today())
 
     # Load a dataset
     if args.dataset == 'dbpedia':
         train, test, vocab = text_datasets.get_dbpedia(
-            char_based=args.char_based)
+            char_based=args.char_based, n_workers=args.n_workers)
     elif args.dataset == 'snli':
         train, test, vocab = text_datasets.get_snli(
-            char_based=args.char_based)
+            char_based=args.char_based, n_workers=args.n_workers)
     elif args.dataset.startswith('imdb.'):
         train, test, vocab = text_datasets.get_imdb(
             fine_grained=args.dataset.endswith('.fine'),
-            char_based=args.char_based)
+            char_based=args.char_based, n_workers=args.n_workers)
     elif args.dataset in ['TREC', 'stsa.binary', 'stsa.fine',
                           'custrev', 'mpqa', 'rt-polarity', 'subj']:
         train, test, vocab = text_datasets.get_other_text_dataset(
-            args.dataset, char_based=args.char_based)
-
-    train_idx = list(range(len(train)))
+            args.dataset, char_based=args.char_based,
+            n_workers=args.n_workers)
 
     # calibration data is taken out of training for calibrated dknn / temperature scaling
-    calibration_idx = sorted(random.sample(train_idx, 1000))
-    calibration = [train[i] for i in calibration_idx]
-    train = [x for i, x in enumerate(train) if i not in calibration_idx]
+    calibration_idx = sorted(random.sample(range(len(train)), 1000))
+    train, _ = split_calibration(train, calibration_idx)
+    if args.dataset != 'snli':
+        # keep the splits as flat token stores for the packed converter
+        train = RaggedDataset.from_examples(train)
+        test = RaggedDataset.from_examples(test)
 
     print('# train data: {}'.format(len(train)))
     print('# test  data: {}'.format(len(test)))
@@ -86,9 +102,15 @@ def main():
         n_class = len(set([int(d[1]) for d in train]))
     print('# class: {}'.format(n_class))
 
-    train_iter = chainer.iterators.SerialIterator(train, args.batchsize)
-    test_iter = chainer.iterators.SerialIterator(test, args.batchsize,
-                                                 repeat=False, shuffle=False)
+    if args.bucket:
+        train_iter = BucketIterator(train, args.batchsize,
+                                    max_tokens=args.max_tokens)
+        test_iter = BucketIterator(test, args.batchsize,
+                                   repeat=False, shuffle=False)
+    else:
+        train_iter = chainer.iterators.SerialIterator(train, args.batchsize)
+        test_iter = chainer.iterators.SerialIterator(
+            test, args.batchsize, repeat=False, shuffle=False)
 
     # Save vocabulary and model's setting
     current = os.path.dirname(os.path.abspath(__file__))
@@ -142,13 +164,11 @@ def main():
     # load word vectors
     if args.word_vectors:
         print("loading word vectors")
-        with open(args.word_vectors, "r") as fi:
-            for line in fi:
-                line_list = line.strip().split(" ")
-                word = line_list[0]
-                if word in vocab:
-                    vec = model.xp.array(line_list[1::], dtype=np.float32)
-                    model.encoder.embed.W.data[vocab[word]] = vec
+        ids, vectors = load_word_vectors(args.word_vectors, vocab)
+        embed = model.encoder.embed
+        # a single host-to-device copy for all found words
+        embed.W.data[embed.xp.asarray(ids)] = embed.xp.asarray(vectors)
+        print('# word vectors: {}'.format(len(ids)))
     else:
         print("WARNING: NO Word Vectors")
 
@@ -163,10 +183,16 @@ def main():
     # optimizer.add_hook(chainer.optimizer.WeightDecay(1e-4))
 
     # Set up a trainer
-    if args.dataset == 'snli':
-        converter = convert_snli_seq
-    else:
-        converter = convert_seq
+    converter = PackedSeqConverter(snli=args.dataset == 'snli')
+
+    if args.prefetch > 0:
+        # batches arrive converted, so the updater and evaluator pass
+        # them through untouched
+        train_iter = PrefetchIterator(train_iter, converter, args.gpu,
+                                      n_prefetch=args.prefetch)
+        test_iter = PrefetchIterator(test_iter, converter, args.gpu,
+                                     n_prefetch=args.prefetch)
+        converter = identity_converter
 
     updater = training.updaters.StandardUpdater(
         train_iter, optimizer,
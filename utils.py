@@ -1,42 +1,44 @@
 import sys
 import json
 
+import numpy
+
 import chainer
+from chainer.backends import cuda
 
 import nets
 import text_datasets
 
-# Loads a model, dataset, vocabulary, and other settings from a stored result
-def setup_model(args):
-    sys.stderr.write(json.dumps(args.__dict__, indent=2) + '\n')
-    setup = json.load(open(args.model_setup))
-    sys.stderr.write(json.dumps(setup, indent=2) + '\n')
+# Returns the id of the device the model is on, -1 for the CPU
+def get_device(model):
+    if model.xp is numpy:
+        return -1
+    return cuda.get_device_from_array(next(model.params()).data).id
 
-    # Load a dataset
-    dataset = setup['dataset']
-    if dataset == 'dbpedia':
-        train, test, vocab = text_datasets.get_dbpedia(
-            char_based=setup['char_based'])
-    elif dataset == 'snli':
-        train, test, vocab = text_datasets.get_snli(
-            char_based=setup['char_based'])
-    elif dataset.startswith('imdb.'):
-        train, test, vocab = text_datasets.get_imdb(
-            fine_grained=dataset.endswith('.fine'),
-            char_based=setup['char_based'])
-    elif dataset in ['TREC', 'stsa.binary', 'stsa.fine',
-                     'custrev', 'mpqa', 'rt-polarity', 'subj']:
-        train, test, vocab = text_datasets.get_other_text_dataset(
-            dataset, char_based=setup['char_based'])
 
-    vocab = json.load(open(setup['vocab_path']))
-    n_class = setup['n_class']
-    print('# train data: {}'.format(len(train)))
-    print('# test  data: {}'.format(len(test)))
-    print('# vocab: {}'.format(len(vocab)))
-    print('# class: {}'.format(n_class))
+# Reads one split ('train' or 'test') of the dataset of a stored result,
+# encoded with its vocabulary
+def load_split(setup, split, vocab):
+    data = text_datasets.get_dataset_split(
+        setup['dataset'], split, vocab, char_based=setup['char_based'])
+    print('# {} data: {}'.format(split, len(data)))
+    return data
 
-    # Setup a model
+
+# Splits the held out calibration examples (the calib.json indices) from
+# the training data. Uses a mask, not a membership test per example
+def split_calibration(train, calibration_idx):
+    held_out = numpy.zeros(len(train), dtype=bool)
+    held_out[calibration_idx] = True
+    calibration = [train[i] for i in calibration_idx]
+    train = [x for x, h in zip(train, held_out) if not h]
+    return train, calibration
+
+
+# Builds the model described by a stored result and loads its parameters,
+# on the GPU gpu (negative for the CPU). with dtype (e.g. numpy.float16),
+# the parameters are cast to it for inference (see nets.cast_params)
+def load_model(setup, n_vocab, gpu=-1, dtype=None):
     if setup['model'] == 'rnn':
         Encoder = nets.RNNEncoder
     elif setup['model'] == 'bilstm':
@@ -45,16 +47,41 @@ def setup_model(args):
         Encoder = nets.CNNEncoder
     elif setup['model'] == 'bow':
         Encoder = nets.BOWMLPEncoder
-    encoder = Encoder(n_layers=setup['layer'], n_vocab=len(vocab),
+    encoder = Encoder(n_layers=setup['layer'], n_vocab=n_vocab,
                       n_units=setup['unit'], dropout=setup['dropout'])
-    if dataset == 'snli':
+    if setup['dataset'] == 'snli':
         model = nets.SNLIClassifier(encoder)
     else:
-        model = nets.TextClassifier(encoder, n_class)
+        model = nets.TextClassifier(encoder, setup['n_class'])
     chainer.serializers.load_npz(setup['model_path'], model)
-    if args.gpu >= 0:
+    # temperature fitted by scaling.py, applied to predicted probabilities
+    model.temperature = setup.get('temperature', 1.)
+    if gpu >= 0:
         # Make a specified GPU current
-        chainer.backends.cuda.get_device_from_id(args.gpu).use()
+        chainer.backends.cuda.get_device_from_id(gpu).use()
         model.to_gpu()  # Copy the model to the GPU
+    if dtype is not None:
+        nets.cast_params(model, dtype)
+    return model
+
+
+# Loads a model, dataset, vocabulary, and other settings from a stored result.
+# Only the dataset splits listed in splits are read, the others are None
+def setup_model(args, splits=('train', 'test')):
+    sys.stderr.write(json.dumps(args.__dict__, indent=2) + '\n')
+    setup = json.load(open(args.model_setup))
+    sys.stderr.write(json.dumps(setup, indent=2) + '\n')
+
+    vocab = json.load(open(setup['vocab_path']))
+    print('# vocab: {}'.format(len(vocab)))
+    print('# class: {}'.format(setup['n_class']))
+
+    # Setup a model
+    model = load_model(setup, len(vocab), args.gpu,
+                       getattr(args, 'dtype', None))
+
+    # Load the dataset splits that are needed
+    train = load_split(setup, 'train', vocab) if 'train' in splits else None
+    test = load_split(setup, 'test', vocab) if 'test' in splits else None
 
     return model, train, test, vocab, setup